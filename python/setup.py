@@ -2,5 +2,5 @@ from distutils.core import setup
 
 setup(name='syncjams',
       version='0.1',
-      py_modules=['syncjams'],
+      py_modules=['syncjams', 'syncjams_sim'],
 )
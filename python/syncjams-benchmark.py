@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# PEP8 all up in here:
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4 smartindent
+
+import sys
+from math import sqrt
+from timeit import Timer
+from argparse import ArgumentParser
+
+import OSC
+
+from syncjams import SyncjamsNode, SyncjamsCodec, NAMESPACE, PROTOCOL_VERSION
+from syncjams_sim import Simulation
+
+# ticks count as converged once every node fires them within this many seconds of each other
+TICK_CONVERGED_SPREAD = 0.01
+
+# the hot messages every node sends - (address, arguments after the protocol version)
+HOT_MESSAGES = [
+    ("/tick", [4534126, 1024, 28632, 37187, 36600]),
+    ("/state/fader/volume", [4534126, 2051, 1024, 0.0123, 96]),
+    ("/state/key/0", [4534126, 2052, 1024, 0.0456, "chord", "maj7", 61]),
+]
+
+def pyosc_encode(address, args):
+    oscmsg = OSC.OSCMessage()
+    oscmsg.setAddress(NAMESPACE + address)
+    oscmsg.append(PROTOCOL_VERSION)
+    [oscmsg.append(a) for a in args]
+    return oscmsg.getBinary()
+
+def pyosc_decode(data, callback):
+    decoded = OSC.decodeOSC(data)
+    callback(decoded[0], decoded[1][1:], decoded[2:], None)
+
+def null_callback(address, tags, args, source):
+    pass
+
+def best_time(fn, number, repeat):
+    # best of several runs, in microseconds per call
+    return min(Timer(fn).repeat(repeat, number)) / number * 1e6
+
+def benchmark_codec(number, repeat):
+    """ Compare the SyncjamsCodec with pyOSC for encoding and decoding the hot SyncJams messages. """
+    codec = SyncjamsCodec()
+    receive_buffer = bytearray(65536)
+    receive_args = []
+    results = []
+    for address, args in HOT_MESSAGES:
+        data = pyosc_encode(address, args)
+        receive_buffer[:len(data)] = data
+        size = len(data)
+        results.append((address, "encode",
+            best_time(lambda: pyosc_encode(address, args), number, repeat),
+            best_time(lambda: codec.encode(address, args), number, repeat)))
+        results.append((address, "decode",
+            best_time(lambda: pyosc_decode(data, null_callback), number, repeat),
+            best_time(lambda: codec.decode(receive_buffer, null_callback, None, 0, size, receive_args), number, repeat)))
+    return results
+
+class BenchmarkNode(SyncjamsNode):
+    """ Node that remembers the virtual time it fired each tick at. """
+    def __init__(self, **kwargs):
+        self.tick_times = {}
+        SyncjamsNode.__init__(self, **kwargs)
+
+    def tick(self, tick, time):
+        self.tick_times[tick] = self.clock()
+
+def states_agree(nodes):
+    checksums = nodes[0]._get_state_checksums()
+    return all([n._get_state_checksums() == checksums for n in nodes[1:]])
+
+def heal_counters(nodes):
+    # anti-entropy messages sent by all the nodes so far (state digests, bucket state ids, rebroadcast states)
+    counters = [n.get_metrics()["counters"] for n in nodes]
+    return [sum([c.get(name, 0) for c in counters]) for name in ("state_digests_sent", "state_bucket_ids_sent", "rebroadcasts")]
+
+def benchmark_network(node_count, key_count, latency=0.002, jitter=0.001, loss=0.0, reorder=0.0, run_time=5.0, partition_time=2.0, timeout=30.0, seed=None, **node_options):
+    """
+        Simulate node_count nodes sharing key_count state keys and measure:
+        * how long until their ticks converge and how far apart they fire each tick after that
+        * how long the state takes to converge after a partition heals, and how many anti-entropy messages that took
+        * packets and bytes per second on the network and the CPU each node spends in poll()
+    """
+    sim = Simulation(latency, jitter, loss, reorder, seed)
+    random = sim.network.random
+    tick_length = 60.0 / 180
+    start = sim.clock()
+    # nodes start at random points within the first beat so their ticks begin out of phase
+    nodes = []
+    for n in range(node_count):
+        nodes.append(sim.add_node(BenchmarkNode, **node_options))
+        sim.run(random.uniform(0, tick_length / node_count))
+    for k in range(key_count):
+        nodes[0].set_state("/bench/%d" % k, k)
+    sim.run(run_time - (sim.clock() - start))
+    
+    # tick convergence and jitter
+    ticks = sorted(set.intersection(*[set(n.tick_times) for n in nodes]))
+    spreads = [(t, max([n.tick_times[t] for n in nodes]) - min([n.tick_times[t] for n in nodes])) for t in ticks]
+    converged = [t for t, spread in spreads if spread <= TICK_CONVERGED_SPREAD]
+    tick_convergence = converged and min([n.tick_times[converged[0]] for n in nodes]) - start or None
+    after = [spread for t, spread in spreads if converged and t >= converged[0]]
+    tick_jitter = after and sqrt(sum([a * a for a in after]) / len(after)) or None
+    initial_agreement = states_agree(nodes)
+    
+    # state convergence after a partition - each half changes some state while they can't hear each other
+    halves = [nodes[:node_count // 2] or nodes[:1], nodes[node_count // 2:]]
+    sim.network.partition(*[[n.transport for n in half] for half in halves])
+    for h, half in enumerate(halves):
+        for k in range(max(1, key_count // 10)):
+            half[random.randrange(len(half))].set_state("/bench/%d" % random.randrange(key_count), [h, k])
+    sim.run(partition_time)
+    sim.network.heal()
+    healed = sim.clock()
+    before = heal_counters(nodes)
+    finished = sim.run(timeout, until=lambda: states_agree(nodes))
+    state_convergence = states_agree(nodes) and finished - healed or None
+    after_heal = heal_counters(nodes)
+    
+    elapsed = sim.clock() - start
+    return {
+        "nodes": node_count,
+        "keys": key_count,
+        "tick_convergence": tick_convergence,
+        "tick_jitter": tick_jitter,
+        "initial_state_agreement": initial_agreement,
+        "state_convergence": state_convergence,
+        "packets_per_second": sim.network.packets_sent / elapsed,
+        "bytes_per_second": sim.network.bytes_sent / elapsed,
+        "cpu_per_node": sum(sim.poll_time.values()) / node_count / elapsed,
+        "heal_digests": after_heal[0] - before[0],
+        "heal_bucket_ids": after_heal[1] - before[1],
+        "heal_rebroadcasts": after_heal[2] - before[2],
+    }
+
+def format_seconds(seconds, scale=1000.0):
+    return seconds is None and "-" or "%.1f" % (seconds * scale)
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the SyncJams Python implementation.")
+    parser.add_argument("-n", "--number", type=int, default=20000, help="calls per timing run")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timing runs to take the best of")
+    parser.add_argument("--nodes", type=int_list, default=[2, 10, 50], help="comma separated node counts to simulate (e.g. 2,20,200)")
+    parser.add_argument("--keys", type=int_list, default=[10, 1000], help="comma separated state key counts to simulate (e.g. 10,1000,10000)")
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated one way network latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.001, help="simulated latency jitter in seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="simulated packet loss probability")
+    parser.add_argument("--reorder", type=float, default=0.0, help="simulated packet reordering probability")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for the simulated network")
+    parser.add_argument("--bundle-states", action="store_true", help="simulate nodes that bundle their state messages")
+    parser.add_argument("--tick-speakers", type=int, default=None, help="simulate nodes where only this many broadcast each tick")
+    parser.add_argument("--skip-codec", action="store_true", help="don't run the codec benchmark")
+    parser.add_argument("--skip-network", action="store_true", help="don't run the simulated network benchmark")
+    options = parser.parse_args()
+
+    if not options.skip_codec:
+        print "OSC codec (microseconds per message)"
+        print "%-24s %-8s %10s %10s %8s" % ("address", "", "pyOSC", "codec", "speedup")
+        for address, operation, pyosc_time, codec_time in benchmark_codec(options.number, options.repeat):
+            print "%-24s %-8s %10.2f %10.2f %7.1fx" % (address, operation, pyosc_time, codec_time, pyosc_time / codec_time)
+        print
+
+    if not options.skip_network:
+        print "Simulated network (latency %.1fms, jitter %.1fms, loss %.0f%%, reorder %.0f%%)" % (options.latency * 1000, options.jitter * 1000, options.loss * 100, options.reorder * 100)
+        print "%6s %6s %12s %10s %12s %10s %10s %10s %8s %10s %12s" % ("nodes", "keys", "tick-sync-ms", "jitter-ms", "state-sync-ms", "packets/s", "kbytes/s", "cpu/node%", "digests", "bucket-ids", "rebroadcasts")
+        for node_count in options.nodes:
+            for key_count in options.keys:
+                r = benchmark_network(node_count, key_count, options.latency, options.jitter, options.loss, options.reorder, seed=options.seed, bundle_states=options.bundle_states, tick_speakers=options.tick_speakers)
+                print "%6d %6d %12s %10s %12s %10.0f %10.1f %10.2f %8d %10d %12d" % (node_count, key_count,
+                    format_seconds(r["tick_convergence"]), format_seconds(r["tick_jitter"]), format_seconds(r["state_convergence"]),
+                    r["packets_per_second"], r["bytes_per_second"] / 1024, r["cpu_per_node"] * 100,
+                    r["heal_digests"], r["heal_bucket_ids"], r["heal_rebroadcasts"])
+                sys.stdout.flush()
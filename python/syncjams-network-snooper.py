@@ -3,12 +3,186 @@
 # PEP8 all up in here:
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4 smartindent
 
-from threading import Thread
-from syncjams import SyncjamsListener
+"""
+    Watch the SyncJams traffic on the network - print it, capture the raw datagrams to a file,
+    or replay a capture into a node or back onto the network to reproduce problems and load test.
+"""
 
-def user_callback(path, tags, args, source):
+import io
+import sys
+import time
+import socket
+import struct
+import signal
+from argparse import ArgumentParser
+
+from syncjams import SyncjamsNode, SyncjamsListener, SyncjamsException, UDPTransport, monotonic, ADDRESSES, ANY, PORT, NAMESPACE, MAX_DATAGRAM
+from syncjams_sim import SimulatedNetwork
+
+# first bytes of every capture file
+CAPTURE_MAGIC = "SYNCJAMS-CAPTURE-1\n"
+# header in front of every captured datagram (monotonic receive time, source IPv4 address, source port, datagram length)
+CAPTURE_RECORD = struct.Struct("<d4sHH")
+# bytes of captured datagrams buffered in memory between writes to the capture file
+CAPTURE_BUFFER_SIZE = 1 << 20
+# how often to report progress while capturing or replaying (seconds)
+REPORT_INTERVAL = 1.0
+
+def print_packet(path, tags, args, source):
     print source
     print "\t", path, tags, args
 
-server = SyncjamsListener("0.0.0.0", 23232, user_callback)
-server.serve_forever()
+def listen(multicast=False, port=PORT, receive_buffer_size=None):
+    return SyncjamsListener(multicast and ADDRESSES["multicast"] or ANY, port, None, receive_buffer_size)
+
+def capture(path, multicast=False, port=PORT, receive_buffer_size=None):
+    """ Write every datagram that arrives to the capture file at path until interrupted. Returns how many were captured. """
+    listener = listen(multicast, port, receive_buffer_size)
+    # read straight into one buffer and write it out undecoded so we keep up with a busy network
+    listener.socket.setblocking(1)
+    receive_buffer = bytearray(MAX_DATAGRAM)
+    view = memoryview(receive_buffer)
+    captured = 0
+    report = monotonic() + REPORT_INTERVAL
+    out = io.open(path, "wb", buffering=CAPTURE_BUFFER_SIZE)
+    out.write(CAPTURE_MAGIC)
+    try:
+        while True:
+            size, source = listener.socket.recvfrom_into(receive_buffer)
+            now = monotonic()
+            out.write(CAPTURE_RECORD.pack(now, socket.inet_aton(source[0]), source[1], size))
+            out.write(view[:size])
+            captured += 1
+            if now >= report:
+                sys.stderr.write("\rcaptured %d packets" % captured)
+                report = now + REPORT_INTERVAL
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        out.close()
+        listener.close()
+    sys.stderr.write("\rcaptured %d packets to %s\n" % (captured, path))
+    return captured
+
+def read_capture(path):
+    """ Yields (receive_time, source, data) for each datagram in a capture file. """
+    f = io.open(path, "rb", buffering=CAPTURE_BUFFER_SIZE)
+    try:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise SyncjamsException("%s is not a SyncJams capture file." % path)
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                break
+            received, host, port, size = CAPTURE_RECORD.unpack(header)
+            data = f.read(size)
+            # a capture that was killed part way through writing a datagram just ends there
+            if len(data) < size:
+                break
+            yield received, (socket.inet_ntoa(host), port), data
+    finally:
+        f.close()
+
+def replay(records, deliver, wait=time.sleep, speed=1.0):
+    """
+        Hand each (receive_time, source, data) record to deliver(data, source) with the same spacing it was captured with, divided by speed.
+        A speed of 0 delivers them as fast as possible. wait(seconds) is called for the gaps. Returns how many records were delivered.
+    """
+    delivered = 0
+    start = None
+    report = monotonic() + REPORT_INTERVAL
+    for received, source, data in records:
+        now = monotonic()
+        if speed:
+            if start is None:
+                start = (received, now)
+            gap = (received - start[0]) / speed - (now - start[1])
+            if gap > 0:
+                wait(gap)
+        deliver(data, source)
+        delivered += 1
+        if now >= report:
+            sys.stderr.write("\rreplayed %d packets" % delivered)
+            report = now + REPORT_INTERVAL
+    return delivered
+
+def replay_to_network(path, speed=1.0, port=PORT, destinations=None, multicast=False):
+    """ Send a capture back out onto the network. """
+    transport = UDPTransport(port, destinations, multicast)
+    started = monotonic()
+    delivered = replay(read_capture(path), lambda data, source: transport.send(data), time.sleep, speed)
+    elapsed = monotonic() - started
+    transport.close()
+    sys.stderr.write("\rsent %d packets in %.3fs (%.0f packets/s)\n" % (delivered, elapsed, delivered / max(elapsed, 1e-9)))
+
+def replay_to_node(path, speed=1.0, namespace=NAMESPACE, **node_options):
+    """ Feed a capture into a SyncjamsNode in this process, as though it had arrived from the network, and return the node. """
+    # a network of one with no latency - the node hears its own packets like it would on a real network
+    network = SimulatedNetwork(monotonic, latency=0, jitter=0)
+    transport = network.transport()
+    node = SyncjamsNode(namespace=namespace, transport=transport, **node_options)
+
+    def drain():
+        network.deliver()
+        while node.poll()[1]:
+            pass
+
+    def deliver(data, source):
+        transport.inbox.append((data, source))
+        # at full speed let a poll's worth of packets queue up, like a busy socket would
+        if len(transport.inbox) >= node.poll_max_packets:
+            drain()
+
+    def wait(seconds):
+        # keep the node's timers running while we wait for the next packet to be due
+        end = monotonic() + seconds
+        drain()
+        while monotonic() < end:
+            time.sleep(max(0, min(node.next_timeout(), end - monotonic())))
+            drain()
+
+    started = monotonic()
+    delivered = replay(read_capture(path), deliver, wait, speed)
+    drain()
+    elapsed = monotonic() - started
+    sys.stderr.write("\rreplayed %d packets into a node in %.3fs (%.0f packets/s)\n" % (delivered, elapsed, delivered / max(elapsed, 1e-9)))
+    return node
+
+def speed_value(value):
+    # "max" means as fast as possible
+    if value == "max":
+        return 0.0
+    return float(value)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Print, capture and replay SyncJams network traffic.")
+    parser.add_argument("-p", "--port", type=int, default=PORT, help="SyncJams UDP port")
+    parser.add_argument("-m", "--multicast", action="store_true", help="use the SyncJams multicast group instead of broadcast")
+    parser.add_argument("-w", "--capture", metavar="FILE", help="write the raw datagrams to FILE instead of printing them")
+    parser.add_argument("-r", "--replay", metavar="FILE", help="replay the datagrams captured in FILE")
+    parser.add_argument("-s", "--speed", type=speed_value, default=1.0, help="replay speed - 1 for real time, N for N times faster or 'max' for as fast as possible")
+    parser.add_argument("--to-network", action="store_true", help="send the replayed datagrams out onto the network instead of into a local node")
+    parser.add_argument("-d", "--destination", action="append", help="address to send replayed datagrams to (may be repeated, defaults to broadcast)")
+    parser.add_argument("--namespace", default=NAMESPACE, help="namespace of the local node replayed datagrams are fed into")
+    parser.add_argument("--receive-buffer-size", type=int, default=None, help="kernel receive buffer size to ask for when capturing")
+    options = parser.parse_args()
+
+    if options.capture and options.replay:
+        parser.error("choose one of --capture and --replay")
+    if options.capture:
+        # stop capturing cleanly when we are killed too, so the end of the capture makes it to disk
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        capture(options.capture, options.multicast, options.port, options.receive_buffer_size)
+    elif options.replay and options.to_network:
+        replay_to_network(options.replay, options.speed, options.port, options.destination, options.multicast)
+    elif options.replay:
+        node = replay_to_node(options.replay, options.speed, options.namespace)
+        for name, value in sorted(node.get_metrics()["counters"].items()):
+            print "%-32s %d" % (name, value)
+        print "%-32s %d" % ("states", len(node.get_state_keys()))
+        print "%-32s %d" % ("nodes", len(node.get_node_list()))
+        node.close()
+    else:
+        server = listen(options.multicast, options.port, options.receive_buffer_size)
+        server.addMsgHandler("default", print_packet)
+        server.serve_forever()
@@ -3,11 +3,23 @@
 # PEP8 all up in here:
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4 smartindent
 
+import os
+import mmap
 import socket
+import struct
+import select
+import errno
 import time
 import sys
+import json
+import zlib
 import logging
+import re
+import threading
 from random import randint
+from bisect import bisect_left, insort
+from heapq import heappush, heappop
+from itertools import count
 
 import OSC
 
@@ -17,9 +29,14 @@ ANY = '0.0.0.0'
 ADDRESSES = {
     "broadcast": '<broadcast>',
     "android": '192.168.42.255',
-    "localhost": '127.0.0.1'
-    # "multicast": '239.255.232.32',
+    "localhost": '127.0.0.1',
+    "multicast": '239.255.232.32',
 }
+# where nodes send to by default - localhost is only used when none of these can be reached
+# (add "android" to reach Android tethering networks - every destination means another copy of every packet)
+DESTINATIONS = ["broadcast"]
+# how many router hops multicast packets may cross (1 keeps them on the local network)
+MULTICAST_TTL = 1
 
 # default namespace for syncjams group of nodes
 NAMESPACE = "/syncjams"
@@ -28,16 +45,99 @@ NAMESPACE = "/syncjams"
 STORE_MESSAGES = 100
 # how many seconds before we decide a node has left
 NODE_TIMEOUT = 30
+# most message ids we will ask for in one /nack packet
+NACK_MAX_IDS = 32
+# gaps in a node's message ids bigger than this are treated as a resync rather than asked for
+NACK_MAX_GAP = 32
+# how long to wait for a re-sent message before asking again, and how many times to ask
+NACK_RETRY_TIME = 0.02
+NACK_RETRIES = 2
+# messages older than this are too stale to re-send (e.g. rhythm triggers)
+NACK_MAX_AGE = 1.0
+# don't re-send the same message again within this many seconds (several nodes may ask for it)
+NACK_SUPPRESS_TIME = 0.005
 # how long to leave between state updates (throttle fast state changes)
 STATE_THROTTLE_TIME = 0.007
+# most packets a single poll() will process before returning (so poll() cost stays bounded)
+POLL_MAX_PACKETS = 64
+# most seconds a single poll() will spend processing packets
+POLL_MAX_TIME = 0.002
+# largest datagram we will receive
+MAX_DATAGRAM = 65536
+# largest OSC bundle we will send when coalescing state messages (fits in one ethernet/wifi frame)
+MAX_BUNDLE_SIZE = 1400
+# port on localhost that metrics snapshots are exported to when asked
+METRICS_PORT = 23233
+# how often to export metrics snapshots (seconds)
+METRICS_INTERVAL = 1.0
 # syncjams protocol information
 PROTOCOL_VERSION = "v2"
+# state anti-entropy buckets - each level splits the address hash space into this many bits worth of children
+STATE_BUCKET_BITS = 4
+# how many levels of buckets below the root we can drill down into
+STATE_BUCKET_DEPTH = 3
+# once a differing bucket holds this few states we send its (node_id, msg_id) pairs instead of drilling further
+STATE_BUCKET_IDS_MAX = 64
+# don't answer about the same state bucket, or rebroadcast the same state, again within this many seconds
+# (every node hears the same digests, so most answers are already on their way from somebody else)
+STATE_ANSWER_SUPPRESS_TIME = 0.05
+# state checksums sent in the ticks of a node that can't vouch for the whole state table and hasn't yet heard anybody else's
+# (nodes don't compare their own checksums with these)
+NO_STATE_CHECKSUMS = [0, 0, 0]
+# how often we measure the round trip time to one of the other nodes (seconds) - nodes are pinged in turn
+PING_INTERVAL = 1.0
+# how many round trip times to average per node
+PING_SAMPLES = 32
+# most of a tick our phase may be moved by at each tick when slewing towards the other nodes
+TICK_SLEW_RATE = 0.05
+# how much of the average phase difference to the other nodes we take out at each tick (less follows network jitter less)
+TICK_SLEW_GAIN = 0.5
+# when a higher tick arrives and we are behind by more than this much of a tick, jump rather than slew
+TICK_SLEW_MAX = 0.1
+# weight given to each new measurement in the smoothed tick phase offset of other nodes
+TICK_OFFSET_SMOOTHING = 0.1
+# most incoming addresses we remember the subscribed callbacks of
+DISPATCH_CACHE_SIZE = 4096
+# how long a joining node waits after first hearing the group before choosing a node to ask for a snapshot (so it has heard them all)
+SNAPSHOT_ELECT_TIME = 0.05
+# how long a joining node waits for a snapshot to start arriving before asking a different node
+SNAPSHOT_TIMEOUT = 0.5
+# how many nodes a joining node asks for a snapshot before falling back to checksum anti-entropy
+SNAPSHOT_ATTEMPTS = 3
+# how long a joining node waits after the last snapshot chunk arrived before asking again for the chunks it lost
+SNAPSHOT_RETRY_TIME = 0.05
+# bytes of encoded state messages that go into each snapshot chunk before it is compressed
+SNAPSHOT_CHUNK_SIZE = 4096
+# snapshot chunks sent at a time, and seconds between each burst (so we don't overflow the joining node's receive buffer)
+SNAPSHOT_BURST = 4
+SNAPSHOT_INTERVAL = 0.005
+# how long a sent snapshot is kept for lost chunks to be asked for again, and other nodes leave the joining node's digests alone
+SNAPSHOT_KEEP_TIME = 5.0
+# how often to check whether the state log has grown enough to be compacted into a snapshot (seconds)
+STATE_LOG_COMPACT_INTERVAL = 10.0
+# the state log is compacted once it is bigger than this many bytes, and bigger than the last snapshot
+STATE_LOG_COMPACT_SIZE = 1 << 20
+# list states at least this long are sent as a delta against the previous value (when delta_states is on)
+DELTA_MIN_LENGTH = 8
+# slots in the queue of callbacks waiting for poll() in background mode, and of calls waiting for the network thread
+EVENT_QUEUE_SIZE = 4096
+COMMAND_QUEUE_SIZE = 1024
+# longest the network thread goes between looking for calls queued by other threads in background mode (seconds)
+COMMAND_INTERVAL = 0.002
+# in scalable tick mode, how many ticks the same nodes are chosen to broadcast them for
+TICK_SPEAKER_EPOCH = 16
+# ticks without hearing from any node chosen ahead of us before we start broadcasting ticks ourselves
+TICK_SPEAKER_TIMEOUT = 2
+# longest a node that isn't chosen to speak goes without broadcasting a tick, so the others know it is still here (seconds)
+TICK_HEARTBEAT_INTERVAL = 5.0
+# longest a SyncjamsHost sleeps for when none of its sessions has timed work to do (seconds)
+HOST_IDLE_TIMEOUT = 1.0
 
 class SyncjamsNode:
     """
         Network synchronised metronome and state for jamming with music applications.
     """
-    def __init__(self, initial_state={}, namespace=NAMESPACE, port=None, loglevel=logging.ERROR, logfile=None):
+    def __init__(self, initial_state={}, namespace=NAMESPACE, port=None, loglevel=logging.ERROR, logfile=None, poll_max_packets=POLL_MAX_PACKETS, poll_max_time=POLL_MAX_TIME, receive_buffer_size=None, bundle_states=False, snapshot_sync=False, state_log=None, delta_states=False, tick_speakers=None, background=False, destinations=None, multicast=False, multicast_interface=None, multicast_ttl=MULTICAST_TTL, transport=None, clock=None, metrics=True, metrics_address=None):
         # set up basic logging
         logging_config = {"level": loglevel}
         if logfile:
@@ -46,6 +146,9 @@ class SyncjamsNode:
         # basic configuration to separate this network singleton from another
         self.port = port or PORT
         self.namespace = namespace
+        # where all the times we use come from (a virtual clock in simulations)
+        # monotonic by default so wall clock adjustments (NTP etc.) don't upset the metronome
+        self.clock = clock or monotonic
         # my randomly chosen NodeID
         # (2^23-1 can be represented completely in 32-bit floating point, which some platforms require)
         # about one in eight million chance of collision
@@ -54,28 +157,157 @@ class SyncjamsNode:
         self.message_id = 0
         # whether or not the server is running
         self.running = False
-        # collection of key->(node_id, message_id, tick, time_offset, value) state variables
-        self.states = {}
+        # budget of packets/seconds each poll() may spend receiving
+        self.poll_max_packets = poll_max_packets
+        self.poll_max_time = poll_max_time
+        # the SyncjamsLoop this node is being run by, if any
+        self.loop = None
+        # in background mode a thread of our own does all the networking and queues our callbacks up here for poll() to run
+        # (None otherwise, when poll() does the networking and callbacks run straight away)
+        self.events = None
+        # and set_state(), send() etc. are queued up here for the network thread to carry out
+        self.commands = None
+        self.network_thread = None
+        # collection of key->StateRecord(node_id, message_id, tick, time_offset, value) state variables
+        self.states = StateStore()
         # last time we saw a client nodeID -> our_timestamp
         self.last_seen = {}
         # last tick that happened (number, time)
-        self.last_tick = (0, time.time())
-        # queue of non-tick messages we have sent
-        self.sent_queue = []
+        self.last_tick = (0, self.clock())
+        # (tick, time, tick_length) of the last tick, always replaced whole so other threads can read it without locking
+        self.tick_clock = None
+        # how many nodes broadcast each tick - None for all of them, otherwise only that many chosen afresh every epoch
+        # (the rest speak up now and then to be seen, when their state checksums disagree, or when the chosen ones go quiet)
+        self.tick_speakers = tick_speakers
+        # our place in this epoch's running (epoch, node_count, our_rank, number_of_nodes_ranked_ahead_of_us, highest_chosen_rank,
+        # highest_rank_in_the_groups_of_speakers_ahead_of_ours) - the nodes after the chosen ones stand in for them in groups of tick_speakers
+        self.tick_speaker_order = (None, 0, 0, 0, 0, -1)
+        # when we last heard a tick from one of the chosen nodes and from any group ahead of ours, and last broadcast one ourselves
+        self.tick_speaker_heard = self.clock()
+        self.tick_ahead_heard = self.clock()
+        self.tick_sent = None
+        # whether a tick's state checksums disagreed with ours since we last broadcast one
+        self.tick_disagreed = False
+        # sum and count of how far behind the other nodes our tick phase has been measured since our last tick
+        # (the average is taken out a little at each tick rather than jumped)
+        self.tick_phase_error = [0.0, 0]
+        # what we know about the timing of other nodes (node_id -> [recent_round_trip_times, smoothed_tick_phase_offset])
+        self.peer_timing = {}
+        # the ping we are waiting for an answer to (ping_id, node_id, sent_time), if any
+        self.ping_outstanding = None
+        self.ping_ids = count(1)
+        # ring buffer of the last STORE_MESSAGES non-tick messages we have sent, indexed by message_id % STORE_MESSAGES
+        # each entry is [message_id, address, outgoing, sent_time, last_resent_time]
+        self.sent_queue = [None] * STORE_MESSAGES
+        # message ids seen from each node so we can spot lost packets (node_id -> [highest_message_id, {missing_message_id: retries}])
+        self.peer_message_ids = {}
         # check sum of state that we send to see if all nodes are in agreement (checksum_name, state:client_id, state:msg_id, state:tick)
+        # (None when the state has changed and the checksums need to be folded again)
         self.state_checksums = [0, 0, 0]
+        # the state checksums in the last tick we heard from another node, which we repeat in our own ticks
+        # while we hold only part of the state table (so that nodes that don't know about that agree with us)
+        self.group_checksums = None
+        # incrementally maintained sorted columns behind each of the three state checksums
+        self.state_checksum_columns = [SortedChecksum() for x in range(3)]
+        # hierarchical digests of the state table for anti-entropy, one dict per level (bucket_prefix -> [digest, keys])
+        self.state_buckets = [{} for x in range(STATE_BUCKET_DEPTH + 1)]
+        # cache of the bucket hash of every state address we know about
+        self.state_key_hashes = {}
+        # when we last sent, or heard another node send, the same answer about a bucket ((address, level, prefix) -> time)
+        self.state_answered = {}
+        # when we last sent, or heard another node send, the state we hold at an address (address -> time)
+        self.state_resent = {}
         # queue for outgoing state messages that are being throttled (address -> last_sent_time, message)
         self.state_throttle_queue = {}
-        # set up an osc sender to send out broadcast messages
-        self.sender = self._make_sender()
-        # set up servers to listen on each broadcast address we want to listen on
-        # self.listeners = [SyncjamsListener(ADDRESSES["multicast"], self.port, callback=self.osc_message_handler)]
-        self.listeners = [SyncjamsListener(ANY, self.port, callback=self._osc_message_handler)]
+        # whether to coalesce state messages sent in the same poll into OSC bundles
+        # (off by default because Pure Data's [oscparse] does not unpack bundles)
+        self.bundle_states = bundle_states
+        # whether to send changes to long list states as /state-delta messages carrying only the changed items
+        # (off by default because Pure Data nodes don't understand them)
+        self.delta_states = delta_states
+        # the full /state arguments of the last delta we sent for each address, for nodes that couldn't apply it
+        # (address -> [arguments, last_time_we_sent_it_in_full])
+        self.delta_sent = {}
+        # OSC messages waiting to go out in bundles at the end of this poll
+        self.outgoing_bundle = []
+        # heap of timed work ordered by when it is due (due_time, sequence, kind, key)
+        self.timers = []
+        # tie breaker so timers due at the same moment come out in the order they were scheduled
+        self.timer_sequence = count()
+        # encoder for outgoing packets
+        self.codec = SyncjamsCodec(self.namespace)
+        # handler for each type of protocol message (anything else is a regular message)
+        self.routes = {
+            "tick": self._handle_tick,
+            "ping": self._handle_ping,
+            "pong": self._handle_pong,
+            "nack": self._handle_nack,
+            "leave": self._handle_leave,
+            "state": self._handle_state,
+            "state-delta": self._handle_state_delta,
+            "state-request": self._handle_state_request,
+            "state-ids": self._handle_state_ids,
+            "state-digest": self._handle_state_digest,
+            "state-bucket-ids": self._handle_state_bucket_ids,
+            "snapshot-request": self._handle_snapshot_request,
+            "snapshot": self._handle_snapshot,
+        }
+        # where the state key starts in an incoming /state and /state-delta address
+        self.state_address_start = len(self.namespace + "/state")
+        self.state_delta_address_start = len(self.namespace + "/state-delta")
+        # address patterns we have subscribed to and their callbacks (None until subscribe() is called, meaning everything)
+        self.subscriptions = None
+        # incoming OSC address -> tuple of the callbacks it should be dispatched to
+        self.dispatch_cache = {}
+        # our progress receiving a snapshot of the state table when we join, if we want one (None once we have it or gave up)
+        # (off by default because Pure Data nodes can't send snapshots, and a group of only new nodes has nothing to send)
+        self.snapshot = snapshot_sync and SnapshotTransfer() or None
+        # snapshots we are sending to joining nodes (node_id -> [transfer_id, compressed_chunks, chunk_numbers_to_send, last_activity_time])
+        self.snapshot_transfers = {}
+        self.snapshot_ids = count(1)
+        # joining nodes that somebody is sending a snapshot to - we leave their digests alone (node_id -> time we last heard of it)
+        self.snapshot_joiners = {}
+        # counters and latency histograms (only kept when metrics is True)
+        self.metrics = SyncjamsMetrics(metrics)
+        # (host, port) to periodically send JSON metrics snapshots to, if any
+        self.metrics_address = metrics_address is True and ("127.0.0.1", METRICS_PORT) or metrics_address
+        self.metrics_socket = None
+        if self.metrics_address:
+            self.metrics_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._schedule(self.clock() + METRICS_INTERVAL, "metrics", None)
+        # measure round trip times to other nodes so we can allow for network latency in their ticks
+        self._schedule(self.clock() + PING_INTERVAL, "ping", None)
+        # file the winning state updates are appended to, so a restarted node comes back with the state it had
+        self.state_log = None
+        if state_log:
+            self.state_log = StateLog(state_log)
+            restored = self.state_log.replay(self.codec, self._restore_state)
+            logging.info("Restored %d states from the state log %s", restored, state_log)
+            self.metrics.count("states_restored", restored)
+            # carry on counting ticks after the latest restored state, so that new changes win over the restored ones
+            if restored:
+                self.last_tick = (max([r.tick for k, r in self.states.items()]) + 1, self.clock())
+            self._schedule(self.clock() + STATE_LOG_COMPACT_INTERVAL, "state-log", None)
+        # what carries our packets to other nodes - UDP broadcast/multicast sockets unless we're given something else
+        self.transport = transport or UDPTransport(self.port, destinations, multicast, multicast_interface, multicast_ttl, receive_buffer_size)
+        self.transport.start(self._handle_packet, self._accept_address)
         # initial BPM state is required
         initial_state["/BPM"] = 180
-        # start by establishing my initial state (at zero logical time)
+        # start by establishing my initial state (at zero logical time, or just after any states we restored)
         for s in initial_state:
-            self.set_state(s, initial_state[s], self.last_tick[1])
+            # (a state we restored is what we had before, so it stays)
+            if not s in self.states:
+                self.set_state(s, initial_state[s], self.last_tick[1])
+        self.tick_clock = self.last_tick + (self._tick_length(),)
+        # hand the networking to a thread of our own so that poll() only has to run callbacks
+        if background:
+            self.events = EventQueue(EVENT_QUEUE_SIZE)
+            # (set_state(), send() etc. are often called from several threads at once - audio and GUI, say)
+            self.commands = EventQueue(COMMAND_QUEUE_SIZE, shared=True)
+            self.running = True
+            self.network_thread = threading.Thread(target=self._run_network, name="syncjams-network")
+            self.network_thread.daemon = True
+            self.network_thread.start()
     
     def set_state(self, address, state=[], force_time=None):
         """
@@ -90,27 +322,60 @@ class SyncjamsNode:
             raise SyncjamsException("State value must be of list, tuple, int, float, or string type.")
         if type(state) in [list, tuple] and len([s for s in state if s is None]):
             raise SyncjamsException("State values must not be None.");
-        # get the current time
-        now = force_time or time.time()
-        # put together the message we are going to send
-        state_message = [self.last_tick[0], now - self.last_tick[1]] + (type(state) in [list, tuple] and state or [state])
-        # check the state throttle queue to make sure we're not sending to one address too fast
-        state_queue = self.state_throttle_queue.get(address, [0, None])
-        # is the state we are changing on the outgoing queue already?
-        if state_queue[0] + STATE_THROTTLE_TIME > now:
-            # retain the previous send time
-            state_queue[1] = state_message
-            # update the state queue entry for this address instead of sending it now
-            self.state_throttle_queue[address] = state_queue
-        else:
-            # set the last sent time in the throttle queue
-            self.state_throttle_queue[address] = [now, None]
-            # send immediately to the network
-            self._send("/state" + address, state_message)
+        self._command(self._set_state, address, state, force_time)
     
     def get_state(self, address):
-        state = self.states.get(address, [None, None, None, None, None])[-1]
-        return len(state) == 1 and state[0] or state
+        """ Returns the current value of a state address - a single value, a list of values, or None if it has never been set. """
+        record = self.states.get(address)
+        if record is None:
+            return None
+        return record.get_value()
+    
+    def get_state_keys(self, prefix="/"):
+        """ Returns a sorted list of all the state addresses starting with prefix (e.g. "/drums/"). """
+        return self.states.keys(prefix)
+    
+    def get_states(self, prefix="/"):
+        """ Returns a dictionary of address -> value (as get_state returns it) for all the state addresses starting with prefix. """
+        return dict([(address, record.get_value()) for address, record in self.states.items(prefix)])
+    
+    def subscribe(self, pattern, callback=None):
+        """
+            Only receive the state changes and messages with addresses matching an OSC address pattern, e.g.
+            "/fader/volume", "/drums/*/velocity", "/fader/[1-4]", "/led/{red,green}/?".
+            callback(node_id, address, *values) runs for each of them, or the state()/message() methods if no callback is given.
+            Until subscribe() is called a node receives everything. Once it has subscriptions, packets for other addresses
+            are dropped as soon as their address is decoded - so the node only holds part of the state table, it repeats the
+            group's checksums in its ticks instead of its own, leaves checksum comparison to the other nodes and doesn't
+            ask for lost messages. "/BPM" is always received.
+        """
+        if not pattern.startswith("/"):
+            raise SyncjamsException("Address pattern must start with '/'.")
+        self._command(self._subscribe, pattern, callback)
+    
+    def unsubscribe(self, pattern, callback=None):
+        """ Remove a subscription made with subscribe(). Once there are none left the node receives everything again. """
+        self._command(self._unsubscribe, pattern, callback)
+    
+    def _subscribe(self, pattern, callback):
+        if self.subscriptions is None:
+            self.subscriptions = AddressPatternTrie()
+        self.subscriptions.add(pattern, callback)
+        self.dispatch_cache.clear()
+    
+    def _unsubscribe(self, pattern, callback):
+        if self.subscriptions is not None:
+            self.subscriptions.remove(pattern, callback)
+            if not len(self.subscriptions):
+                self.subscriptions = None
+            self.dispatch_cache.clear()
+    
+    def get_metrics(self):
+        """
+            Returns a snapshot of this node's runtime metrics:
+            {"counters": {name: count}, "histograms": {name: {"count", "sum", "max", "buckets": {upper_bound_microseconds: count}}}}
+        """
+        return self.metrics.snapshot()
     
     def get_node_id(self):
         """ Returns this node's unique ID. """
@@ -120,38 +385,101 @@ class SyncjamsNode:
         """ Returns a list of all known nodes currently connected to the group. """
         return self.last_seen.keys()
     
+    def get_node_latency(self, node_id):
+        """ Returns our estimate of the one way network delay from another node in seconds, or None if we haven't measured it yet. """
+        round_trips = self.peer_timing.get(node_id, [[]])[0]
+        return round_trips and sum(round_trips) / len(round_trips) / 2 or None
+    
+    def get_tick_position(self, now=None):
+        """ Returns where the metronome is at now, in ticks (e.g. 12.25 is a quarter of the way through tick 12). Safe to call from any thread. """
+        tick, tick_time, tick_length = self.tick_clock
+        return tick + ((now or self.clock()) - tick_time) / tick_length
+    
+    def get_node_offset(self, node_id):
+        """ Returns how many seconds after ours another node's ticks start (negative if theirs are earlier), allowing for network delay, or None if we haven't heard any. """
+        return self.peer_timing.get(node_id, [None, None])[1]
+    
     def send(self, address, value=[]):
         """ Broadcast an arbitrary message to all nodes. Good for ephemeral rhythm/trigger information. """
         if not type(value) in [list, tuple, int, float, str]:
             raise SyncjamsException("Message value must be of list, tuple, int, float, or string type.")
         if type(value) in [list, tuple] and len([v for v in value if v is None]):
             raise SyncjamsException("Message value must not contain None.");
-        self._send(address, value)
+        # addresses the protocol's own messages use would never reach the other nodes' message() callbacks
+        if address[1:].split("/", 1)[0] in self.routes:
+            raise SyncjamsException("Message address %s is reserved for the protocol." % address)
+        self._command(self._send, address, value)
     
-    def poll(self):
-        """ Run the SyncJams inner loop once, processing network messages etc. Good to call once for every frame of audio data processed. """
-        for s in self.listeners:
-            s.handle_request()
+    def poll(self, max_packets=None, max_time=None):
+        """
+            Run the SyncJams inner loop once, processing network messages etc. Good to call once for every frame of audio data processed.
+            Drains waiting packets up to max_packets/max_time (defaulting to the node's poll budget).
+            Returns (packets_processed, more_pending) where more_pending is True if packets were left waiting when the budget ran out.
+            In background mode the network thread has already done all of that, so poll() just runs up to max_packets
+            of the callbacks it queued and returns (callbacks_run, more_pending) - no socket calls, no waiting on locks.
+        """
+        if self.events is not None:
+            ran = self.events.run(max_packets or self.poll_max_packets)
+            return ran, len(self.events) > 0
+        return self._poll_network(max_packets, max_time)
+    
+    def _poll_network(self, max_packets=None, max_time=None):
+        started = time.time()
+        max_packets = max_packets or self.poll_max_packets
+        deadline = started + (max_time or self.poll_max_time)
+        processed, pending = self.transport.receive(max_packets, deadline)
         self._process_tick()
+        # send everything that was coalesced during this poll
+        self._flush_bundle()
+        # and get this poll's state changes on their way to disk
+        if self.state_log:
+            self.state_log.flush()
+        if self.metrics.enabled:
+            self.metrics.observe("poll_time", time.time() - started)
+        return processed, pending
+    
+    def next_timeout(self, now=None):
+        """ Returns how many seconds until this node next has timed work to do (a tick or a throttled state) - poll() can wait this long if no packets arrive. """
+        now = now or self.clock()
+        if self.outgoing_bundle:
+            return 0
+        due = self._next_tick_time(self._tick_length())
+        if self.timers:
+            due = min(due, self.timers[0][0])
+        return max(0, due - now)
     
     def serve_forever(self):
         """ Set up a loop running the poll() method until close() is called. Good to call inside a Thread. """
+        if self.events is not None:
+            raise SyncjamsException("A node in background mode already has its own network thread.")
         self.running = True
-        while self.running:
-            self.poll()
-            time.sleep(0.001)
+        loop = SyncjamsLoop([self])
+        loop.run()
+        loop.close()
     
     def close(self):
         """ Shut down the server and quit the serve_forever() loop, if running. """
-        self._send("/leave")
         self.running = False
-        [s.close() for s in self.listeners]
-        self.sender.close()
+        # let the network thread finish what it was doing before we say goodbye from this one
+        if self.network_thread and self.network_thread is not threading.current_thread():
+            self.network_thread.join()
+            # carry out any calls that were still waiting for it
+            self.commands.run()
+        # send any state messages still waiting to be bundled before we go
+        self._flush_bundle()
+        self._send("/leave")
+        if self.loop:
+            self.loop.remove(self)
+        self.transport.close()
+        if self.metrics_socket:
+            self.metrics_socket.close()
+        if self.state_log:
+            self.state_log.close()
     
     ### Methods to override. ###
     
     def tick(self, tick, time):
-        """ A network-consensus metronome tick. """
+        """ A network-consensus metronome tick. time is when the tick started on this node's clock, allowing for network latency. """
         pass
     
     def message(self, node_id, address, *args):
@@ -174,69 +502,460 @@ class SyncjamsNode:
     
     def _process_tick(self):
         last_tick = self.last_tick[1]
-        now = time.time()
+        now = self.clock()
         tick_length = self._tick_length()
         # while our metronome is behind, catch it up
-        while self.last_tick[1] + tick_length < now:
+        while self._next_tick_time(tick_length) < now:
+            # take a little of any phase error out of this tick
+            next_tick = self._next_tick_time(tick_length)
+            self.tick_phase_error = [0.0, 0]
             # calculate new tick position and time
-            self.last_tick = (self.last_tick[0] + 1, self.last_tick[1] + tick_length)
+            self.last_tick = (self.last_tick[0] + 1, next_tick)
             # register the current new tick so we can run code
-            self.tick(*self.last_tick)
+            self._notify(self.tick, *self.last_tick)
         # if the tick changed then broadcast the tick we think we are up to
-        if last_tick != self.last_tick[1]:
+        if last_tick != self.last_tick[1] and self._tick_speaking(now):
             self._broadcast_tick()
-            # every tick forget about any nodes we haven't seen in a while
-            self._forget_old_nodes(now)
-        # check for any states that have been throttled to now be sent
-        self._send_queued_states(now)
+        self.tick_clock = self.last_tick + (tick_length,)
+        # send throttled states and forget silent nodes - only the timers that are actually due
+        self._process_timers(now)
+    
+    def _next_tick_time(self, tick_length):
+        # when our next tick is due, moved a little towards the average phase of the other nodes
+        error_sum, error_count = self.tick_phase_error
+        correction = error_count and TICK_SLEW_GAIN * error_sum / error_count or 0
+        limit = TICK_SLEW_RATE * tick_length
+        return self.last_tick[1] + tick_length - max(-limit, min(limit, correction))
+    
+    def _notify(self, callback, *args):
+        # run a user callback now, or queue it up for poll() in background mode
+        if self.events is None:
+            callback(*args)
+        elif not self.events.put(callback, args):
+            self.metrics.count("events_dropped")
+    
+    def _command(self, function, *args):
+        # carry out a call now, or hand it to the network thread in background mode
+        if self.commands is None:
+            function(*args)
+        elif not self.commands.put(function, args):
+            raise SyncjamsException("Too many calls waiting for the network thread.")
+    
+    def _run_network(self):
+        # the background network thread - does everything poll() would, plus the calls queued by other threads
+        filenos = self.transport.filenos()
+        while self.running:
+            timeout = min(self.next_timeout(), COMMAND_INTERVAL)
+            try:
+                if filenos:
+                    select.select(filenos, [], [], timeout)
+                else:
+                    time.sleep(timeout)
+                self.commands.run()
+                self._poll_network()
+            except Exception, e:
+                # keep the network going - whatever went wrong only affected one packet or call
+                if self.running:
+                    logging.warning("Error in the network thread: %r", e)
+    
+    def _schedule(self, due, kind, key):
+        # add some timed work to the heap - it is run by _process_timers once due
+        heappush(self.timers, (due, self.timer_sequence.next(), kind, key))
+    
+    def _process_timers(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            due, sequence, kind, key = heappop(self.timers)
+            if kind == "state":
+                self._send_queued_state(key, now)
+            elif kind == "expire":
+                self._expire_node(key, now)
+            elif kind == "nack":
+                self._retry_nacks(key, now)
+            elif kind == "metrics":
+                self._export_metrics()
+                self._schedule(now + METRICS_INTERVAL, "metrics", None)
+            elif kind == "snapshot-send":
+                self._send_snapshot_chunks(key, now)
+            elif kind == "snapshot-receive":
+                self._check_snapshot(now)
+            elif kind == "state-log":
+                if self.state_log.needs_compacting():
+                    self.state_log.compact(self._encode_states())
+                    self.metrics.count("state_log_compactions")
+                self._schedule(now + STATE_LOG_COMPACT_INTERVAL, "state-log", None)
+            elif kind == "ping":
+                self._send_ping(now)
+                self._schedule(now + PING_INTERVAL, "ping", None)
+    
+    def _expire_node(self, node_id, now):
+        last_seen = self.last_seen.get(node_id)
+        if last_seen is not None:
+            # we have heard from them since this timer was set, so check again later
+            if last_seen + NODE_TIMEOUT > now:
+                self._schedule(last_seen + NODE_TIMEOUT, "expire", node_id)
+            else:
+                self._forget_old_nodes(now, [node_id])
     
     def _forget_old_nodes(self, now, forget=[]):
-            # find nodes we have not heard from for more than timeout
-            forget = forget + [node_id for node_id in self.last_seen if (self.last_seen[node_id] + NODE_TIMEOUT < now)]
+            # only forget about nodes we actually know
+            forget = [node_id for node_id in forget if node_id in self.last_seen]
             if forget:
-                logging.info("forgetting nodes %s" % forget)
+                logging.info("forgetting nodes %s", forget)
             # remove references to those nodes
             for node_id in forget:
                 # actually remove this node from all of our lists
                 del self.last_seen[node_id]
+                self.peer_message_ids.pop(node_id, None)
+                self.peer_timing.pop(node_id, None)
+                self.snapshot_transfers.pop(node_id, None)
+                self.snapshot_joiners.pop(node_id, None)
                 # run the node_left callback method
-                self.node_left(node_id)
+                self._notify(self.node_left, node_id)
     
-    def _update_state_checksums(self):
+    def _update_state_buckets(self, key, old=None, new=None):
+        # swap the replaced state's digest for the new one in every bucket above it
+        key_hash = self.state_key_hashes.get(key)
+        if key_hash is None:
+            key_hash = self.state_key_hashes[key] = _address_hash(key)
+        entry_change = (old and _state_entry_hash(key_hash, old.node_id, old.message_id) or 0) ^ _state_entry_hash(key_hash, new.node_id, new.message_id)
+        for level in range(STATE_BUCKET_DEPTH + 1):
+            prefix = _bucket_prefix(key_hash, level)
+            bucket = self.state_buckets[level].get(prefix)
+            if bucket is None:
+                bucket = self.state_buckets[level][prefix] = [0, set()]
+            bucket[0] ^= entry_change
+            bucket[1].add(key)
+    
+    def _update_state_checksums(self, old=None, new=None):
             # for the first three elements of each state (node_id, msg_id, tick)
-            # generate a checksum based on the sorted list of those values
-            state_checksums = []
-            for x in range(3):
-                sum_source = sorted([self.states[s][x] for s in self.states])
-                state_checksums.append(self._array_checksum(sum_source))
-            self.state_checksums = state_checksums
-            logging.info("Updated state checksums %s" % self.state_checksums)
+            # swap the replaced state's values for the new ones in the sorted columns
+            node_ids, message_ids, ticks = self.state_checksum_columns
+            node_ids.replace(old and old.node_id, new and new.node_id)
+            message_ids.replace(old and old.message_id, new and new.message_id)
+            ticks.replace(old and old.tick, new and new.tick)
+            # the checksums themselves are only folded when somebody needs them
+            self.state_checksums = None
+    
+    def _get_state_checksums(self):
+        # fold any changed sorted columns into the wire checksums (once per tick at most)
+        if self.state_checksums is None:
+            self.state_checksums = [c.checksum() for c in self.state_checksum_columns]
+            logging.info("Updated state checksums %s", self.state_checksums)
+        return self.state_checksums
+    
+    def _tick_speaking(self, now):
+        # whether to broadcast our tick this time - every node does, unless only a few speakers are wanted
+        if not self.tick_speakers or self.tick_disagreed:
+            return True
+        epoch, ahead = self._tick_speaker_place()
+        if ahead < self.tick_speakers:
+            return True
+        # now and then so that the other nodes know we're still here
+        if self.tick_sent is None or now - self.tick_sent >= TICK_HEARTBEAT_INTERVAL:
+            return True
+        # and when the groups ahead of ours have gone quiet, the next group in line speaks up for them, a tick later for each group
+        # (the others in our group don't count, so the whole group speaks up together)
+        silent = (now - self.tick_ahead_heard) / self._tick_length()
+        return silent >= TICK_SPEAKER_TIMEOUT + ahead // self.tick_speakers - 1
+    
+    def _tick_speaker_place(self):
+        # (epoch, how many of the nodes we know are ranked ahead of us in it) - the ones with the lowest ranks speak
+        epoch = self.last_tick[0] // TICK_SPEAKER_EPOCH
+        if self.tick_speaker_order[:2] != (epoch, len(self.last_seen)):
+            if epoch != self.tick_speaker_order[0]:
+                # give the newly chosen nodes a moment to be heard
+                self.tick_speaker_heard = self.tick_ahead_heard = self.clock()
+            rank = _speaker_rank(self.node_id, epoch)
+            ranks = sorted(set([_speaker_rank(n, epoch) for n in self.last_seen] + [rank]))
+            ahead = bisect_left(ranks, rank)
+            group_start = ahead - ahead % self.tick_speakers
+            self.tick_speaker_order = (epoch, len(self.last_seen), rank, ahead, ranks[min(self.tick_speakers, len(ranks)) - 1], ranks[group_start - 1] if group_start else -1)
+        return self.tick_speaker_order[0], self.tick_speaker_order[3]
     
     def _broadcast_tick(self):
         # broadcast what we think the current tick is to the network
         # and checksums for what we think current state is
+        # (a node holding only the states it subscribed to, or still waiting for its snapshot,
+        # can't vouch for the whole table, so it repeats the checksums it last heard instead)
+        self.tick_sent = self.clock()
+        self.tick_disagreed = False
         self._send_one_to_all("/tick",
             [self.node_id, self.last_tick[0]] +
-            self.state_checksums
+            (self.subscriptions is None and self.snapshot is None and self._get_state_checksums() or self.group_checksums or NO_STATE_CHECKSUMS)
         )
     
+    def _state_answer_due(self, answer, now):
+        # whether nobody (including us) has just sent this answer about a bucket - and if so, that we're sending it now
+        if self.state_answered.get(answer, 0) + STATE_ANSWER_SUPPRESS_TIME > now:
+            self.metrics.count("state_answers_suppressed")
+            return False
+        self.state_answered[answer] = now
+        return True
+    
+    def _broadcast_state_digest(self, level=0, prefix=0):
+        # broadcast a digest of each child bucket under this one so other nodes can find out which parts of the state table differ
+        if not self._state_answer_due(("/state-digest", level, prefix), self.clock()):
+            return
+        children = []
+        for child in self._bucket_children(level, prefix):
+            bucket = self.state_buckets[level + 1].get(child, [0, ()])
+            children += [len(bucket[1]), bucket[0]]
+        self._send_one_to_all("/state-digest", [self.node_id, level, prefix] + children)
+        self.metrics.count("state_digests_sent")
+    
     def _broadcast_state_ids(self):
         # broadcast what we think the current state map is - (node_id, msg_id) pairs are unique
-        self._send_one_to_all("/state-ids", [self.node_id] + sum([self.states[s][:2] for s in self.states], []))
-    
-    def _send_queued_states(self, now):
-        # make a copy because we might happen in a thread
-        throttle_queue = self.state_throttle_queue.copy()
-        for s in throttle_queue:
-            state_queue = throttle_queue[s][:]
-            # is the state we are changing on the outgoing queue already?
-            if state_queue[1] and state_queue[0] + STATE_THROTTLE_TIME < now:
-                # set the last sent time in the throttle queue
-                self.state_throttle_queue[s] = [now, None]
-                # send immediately to the network
-                self._send("/state" + s, state_queue[1])
-    
-    def _send(self, address, message=[]):
+        # (for nodes that don't understand digests, which only ask us for our states this way)
+        if not self._state_answer_due(("/state-ids", 0, 0), self.clock()):
+            return
+        self._send_one_to_all("/state-ids", [self.node_id] + sum([[r.node_id, r.message_id] for k, r in self.states.items()], []))
+        self.metrics.count("state_ids_sent")
+    
+    def _broadcast_bucket_state_ids(self, level, prefix):
+        # broadcast the unique (node_id, msg_id) pairs of just the states we hold in one bucket
+        if not self._state_answer_due(("/state-bucket-ids", level, prefix), self.clock()):
+            return
+        state_ids = []
+        for s in self.state_buckets[level].get(prefix, [0, ()])[1]:
+            record = self.states.get(s)
+            state_ids += [record.node_id, record.message_id]
+        self._send_one_to_all("/state-bucket-ids", [self.node_id, level, prefix] + state_ids)
+        self.metrics.count("state_bucket_ids_sent")
+    
+    def _bucket_children(self, level, prefix):
+        return range(prefix << STATE_BUCKET_BITS, (prefix + 1) << STATE_BUCKET_BITS)
+    
+    def _rebroadcast_missing_states(self, keys, their_state_keys):
+        # find states they don't have, and which are older than 1 tick
+        # (and which nobody has just sent - other nodes holding the same state will have heard the same request)
+        now = self.clock()
+        for s in keys:
+            record = self.states.get(s)
+            if not (record.node_id, record.message_id) in their_state_keys and record.tick + 1 < self.last_tick[0]:
+                if self.state_resent.get(s, 0) + STATE_ANSWER_SUPPRESS_TIME > now:
+                    self.metrics.count("rebroadcasts_suppressed")
+                    continue
+                self.state_resent[s] = now
+                # rebroadcast the state message
+                self._send_one_to_all("/state" + s, record.message(), bundle=True)
+                self.metrics.count("rebroadcasts")
+                logging.info("Rebroadcasting state: %s = %s", s, record)
+        self._flush_bundle()
+    
+    def _set_state(self, address, state, force_time=None):
+        # get the current time
+        now = force_time or self.clock()
+        # put together the message we are going to send
+        state_message = [self.last_tick[0], now - self.last_tick[1]] + (type(state) in [list, tuple] and state or [state])
+        # check the state throttle queue to make sure we're not sending to one address too fast
+        state_queue = self.state_throttle_queue.get(address, [0, None])
+        # is the state we are changing on the outgoing queue already?
+        if state_queue[0] + STATE_THROTTLE_TIME > now:
+            # a send is already scheduled if there was a throttled state waiting
+            pending = state_queue[1]
+            self.metrics.count(pending and "states_coalesced" or "states_throttled")
+            # retain the previous send time
+            state_queue[1] = state_message
+            # update the state queue entry for this address instead of sending it now
+            self.state_throttle_queue[address] = state_queue
+            if not pending:
+                # schedule the send for when the throttle time is up
+                self._schedule(state_queue[0] + STATE_THROTTLE_TIME, "state", address)
+                # make sure a loop waiting on the network wakes up in time to send it
+                if self.loop:
+                    self.loop.wake(self)
+        else:
+            # set the last sent time in the throttle queue
+            self.state_throttle_queue[address] = [now, None]
+            # send immediately to the network
+            self._send_state(address, state_message)
+            # when bundling, a loop waiting on the network needs to wake up to send it
+            if self.bundle_states and self.loop:
+                self.loop.wake(self)
+    
+    def _send_state(self, address, state_message):
+        # send a state change - as a delta against the value we hold if only a few of a long list's items changed
+        current = self.delta_states and len(state_message) - 2 >= DELTA_MIN_LENGTH and self.states.get(address)
+        if current:
+            value = state_message[2:]
+            old = current.value
+            changes = []
+            for i in range(len(value)):
+                if i >= len(old) or value[i] != old[i]:
+                    changes += [i, value[i]]
+            if len(changes) < len(value):
+                self._send("/state-delta" + address, state_message[:2] + [current.node_id, current.message_id, len(value)] + changes, bundle=True)
+                self.delta_sent[address] = [[self.node_id, self.message_id] + state_message, 0]
+                self.metrics.count("state_deltas_sent")
+                return
+        self.delta_sent.pop(address, None)
+        self._send("/state" + address, state_message, bundle=True)
+    
+    def _send_queued_state(self, address, now):
+        state_queue = self.state_throttle_queue.get(address)
+        # is there still a throttled state waiting to go out for this address?
+        if state_queue and state_queue[1]:
+            # set the last sent time in the throttle queue
+            self.state_throttle_queue[address] = [now, None]
+            # send immediately to the network
+            self._send_state(address, state_queue[1])
+    
+    def _track_message_id(self, node_id, message_id, now):
+        # returns True the first time we see a particular message from a node, asking for any we skipped
+        peer = self.peer_message_ids.get(node_id)
+        if peer is None:
+            self.peer_message_ids[node_id] = [message_id, {}]
+            return True
+        highest, missing = peer
+        if message_id > highest:
+            gap = range(highest + 1, message_id)
+            if 0 < len(gap) <= NACK_MAX_GAP:
+                for m in gap:
+                    missing[m] = 0
+                if self.subscriptions is None:
+                    # we missed some messages in between so ask for them straight away
+                    self._send_nack(node_id, gap)
+                    self._schedule(now + NACK_RETRY_TIME, "nack", node_id)
+                else:
+                    # a node with subscriptions never sees most message ids so it can't tell which were lost -
+                    # just remember the recent gaps so that messages arriving out of order are still delivered
+                    for m in [m for m in missing if m <= message_id - NACK_MAX_GAP]:
+                        del missing[m]
+            peer[0] = message_id
+            return True
+        if message_id in missing:
+            del missing[message_id]
+            return True
+        return False
+    
+    def _retry_nacks(self, node_id, now):
+        peer = self.peer_message_ids.get(node_id)
+        if peer:
+            missing = peer[1]
+            retry = []
+            for m in missing.keys():
+                if missing[m] < NACK_RETRIES:
+                    missing[m] += 1
+                    retry.append(m)
+                else:
+                    # give up - states will still be recovered by the checksums
+                    del missing[m]
+            if retry:
+                self._send_nack(node_id, sorted(retry))
+                self._schedule(now + NACK_RETRY_TIME, "nack", node_id)
+    
+    def _send_nack(self, node_id, message_ids):
+        logging.info("Asking node %d for missed messages %s", node_id, message_ids)
+        self.metrics.count("nacks_sent")
+        for x in range(0, len(message_ids), NACK_MAX_IDS):
+            self._send_one_to_all("/nack", [self.node_id, node_id] + message_ids[x:x + NACK_MAX_IDS])
+    
+    def _resend_messages(self, message_ids, now):
+        for message_id in message_ids:
+            sent = self.sent_queue[message_id % STORE_MESSAGES]
+            # only if it's still in the ring, not stale, and nobody else just asked for it
+            if sent and sent[0] == message_id and sent[3] + NACK_MAX_AGE > now and sent[4] + NACK_SUPPRESS_TIME < now:
+                sent[4] = now
+                self._send_one_to_all(sent[1], sent[2], bundle=True)
+                self.metrics.count("messages_resent")
+        self._flush_bundle()
+    
+    def _send_ping(self, now):
+        # ask the next of the other nodes in turn to answer straight back so we can time the round trip
+        peers = sorted([n for n in self.last_seen if n != self.node_id])
+        if peers:
+            ping_id = self.ping_ids.next()
+            node_id = peers[ping_id % len(peers)]
+            # only the latest ping is waited for
+            self.ping_outstanding = (ping_id, node_id, now)
+            self._send_one_to_all("/ping", [self.node_id, node_id, ping_id])
+    
+    def _track_pong(self, node_id, ping_id, now):
+        if self.ping_outstanding and self.ping_outstanding[:2] == (ping_id, node_id):
+            round_trips = self.peer_timing.setdefault(node_id, [[], None])[0]
+            round_trips.append(now - self.ping_outstanding[2])
+            del round_trips[:-PING_SAMPLES]
+            self.ping_outstanding = None
+            if self.metrics.enabled:
+                self.metrics.observe("round_trip_time", round_trips[-1])
+    
+    def _track_tick_offset(self, node_id, offset):
+        # smooth the offset of another node's tick phase from ours
+        timing = self.peer_timing.setdefault(node_id, [[], None])
+        timing[1] = timing[1] is None and offset or timing[1] + TICK_OFFSET_SMOOTHING * (offset - timing[1])
+    
+    def _encode_states(self):
+        # the original /state message of every state we hold
+        for key, record in self.states.items():
+            yield self.codec.encode("/state" + key, record.message())
+    
+    def _snapshot_chunks(self):
+        # the whole state table as zlib compressed OSC bundles of the original /state messages
+        chunks = []
+        messages = []
+        size = 0
+        for message in self._encode_states():
+            messages.append(message)
+            size += len(message)
+            if size >= SNAPSHOT_CHUNK_SIZE:
+                chunks.append(bytearray(zlib.compress(self.codec.encode_bundle(messages))))
+                messages = []
+                size = 0
+        if messages or not chunks:
+            chunks.append(bytearray(zlib.compress(self.codec.encode_bundle(messages))))
+        return chunks
+    
+    def _send_snapshot_chunks(self, node_id, now):
+        # send the next few chunks of a snapshot we are sending a joining node
+        transfer = self.snapshot_transfers.get(node_id)
+        if transfer is None:
+            return
+        transfer_id, chunks, to_send, last_activity = transfer
+        if not to_send:
+            # all sent - forget it once they have had time to ask for any they lost
+            if last_activity + SNAPSHOT_KEEP_TIME <= now:
+                del self.snapshot_transfers[node_id]
+            else:
+                self._schedule(last_activity + SNAPSHOT_KEEP_TIME, "snapshot-send", node_id)
+            return
+        for chunk in to_send[:SNAPSHOT_BURST]:
+            self._send_one_to_all("/snapshot", [self.node_id, node_id, transfer_id, chunk, len(chunks), chunks[chunk]])
+            self.metrics.count("snapshot_chunks_sent")
+        del to_send[:SNAPSHOT_BURST]
+        transfer[3] = now
+        self._schedule(now + (to_send and SNAPSHOT_INTERVAL or SNAPSHOT_KEEP_TIME), "snapshot-send", node_id)
+    
+    def _check_snapshot(self, now):
+        # a joining node choosing who to ask for a snapshot, and asking again for lost chunks
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
+        if snapshot.node_id is None or now - snapshot.last_heard >= (snapshot.received and SNAPSHOT_KEEP_TIME or SNAPSHOT_TIMEOUT):
+            # the lowest node id we haven't already tried is the one that sends us the snapshot
+            candidates = sorted([n for n in self.last_seen if n != self.node_id and not n in snapshot.asked])
+            if not candidates or len(snapshot.asked) >= SNAPSHOT_ATTEMPTS:
+                logging.info("No snapshot from nodes %s, falling back to state checksums", snapshot.asked)
+                self.metrics.count("snapshots_failed")
+                self.snapshot = None
+                return
+            snapshot.start(candidates[0], now)
+            self._send_one_to_all("/snapshot-request", [self.node_id, snapshot.node_id, 0])
+        elif snapshot.received and now - snapshot.last_heard >= SNAPSHOT_RETRY_TIME:
+            # the chunks stopped coming - ask for the ones we lost
+            missing = [c for c in range(snapshot.total) if not c in snapshot.received][:NACK_MAX_IDS]
+            self._send_one_to_all("/snapshot-request", [self.node_id, snapshot.node_id, snapshot.transfer_id] + missing)
+            snapshot.last_heard = now
+        self._schedule(now + SNAPSHOT_RETRY_TIME, "snapshot-receive", None)
+    
+    def _snapshot_joining(self, node_id):
+        # whether a node is being sent a snapshot right now (so it doesn't need states rebroadcast to it)
+        heard = self.snapshot_joiners.get(node_id)
+        if heard is not None and heard + SNAPSHOT_KEEP_TIME <= self.clock():
+            del self.snapshot_joiners[node_id]
+            heard = None
+        return heard is not None
+    
+    def _send(self, address, message=[], bundle=False):
         if not address.startswith("/"):
             raise SyncjamsException("Address must start with '/'.")
         # message_id increments for every message
@@ -252,16 +971,24 @@ class SyncjamsNode:
                 outgoing.append(m)
         else:
             outgoing.append(message)
-        # push the message onto our queue of potential repeats
-        self.sent_queue.append((self.message_id, address, outgoing))
-        # make sure our queue of sent messages stays an ok size
-        self.sent_queue = self.sent_queue[-STORE_MESSAGES:]
+        # put the message in our ring of potential repeats
+        self.sent_queue[self.message_id % STORE_MESSAGES] = [self.message_id, address, outgoing, self.clock(), 0]
         # send the message to all broadcast networks
-        self._send_one_to_all(address, outgoing)
+        self._send_one_to_all(address, outgoing, bundle)
+    
+    def _handle_packet(self, addr, tags, packet, source):
+        # time how long each incoming message takes to handle
+        if self.metrics.enabled:
+            started = time.time()
+            self._osc_message_handler(addr, tags, packet, source)
+            self.metrics.observe("handler_time", time.time() - started)
+        else:
+            self._osc_message_handler(addr, tags, packet, source)
     
     # message-handler function that servers will call when a message is received.
+    # packet may be a buffer that is reused for the next message so it must not be kept.
     def _osc_message_handler(self, addr, tags, packet, source):
-        logging.debug("raw packet %s %s" % (addr, packet))
+        logging.debug("raw packet %s %s", addr, packet)
         
         # bail if incoming packets are not addressed to our top level namespace
         if not addr.startswith(self.namespace):
@@ -269,104 +996,440 @@ class SyncjamsNode:
             return
         
         # bail if we don't know the version of syncjams
-        version = packet.pop(0)
+        version = packet and packet[0]
         if version != PROTOCOL_VERSION:
             self._drop("Wrong protocol version", addr, tags, packet, source)
             return
         
         # every message should contain the other client's id
-        node_id = self._parse_number_slot(packet)
+        node_id = self._parse_number_slot(packet, 1)
         # bail if there wasn't a valid client id
         if not node_id:
             self._drop("No node_id", addr, tags, packet, source)
             return
         
-        # digestible format for our address routing
-        route = addr[len(self.namespace) + 1:].split("/")
+        # the protocol message type is the first part of the address after our namespace
+        route = addr[len(self.namespace) + 1:].split("/", 1)[0]
         
         # bail if invalid address - no components
-        if not len(route):
+        if not route:
             self._drop("No valid address", addr, tags, packet, source)
             return
         
+        # (regular messages are all counted together, so peers can't make us keep a counter per address)
+        if self.metrics.enabled:
+            self.metrics.count("packets_in." + (route in self.routes and route or "message"))
+        
+        # anything that isn't part of the protocol is a regular message
+        error = self.routes.get(route, self._handle_message)(node_id, addr, packet)
+        if error:
+            self._drop(error, addr, tags, packet, source, route)
+    
+    # handlers for each type of protocol message - they return a reason if the packet had to be dropped
+    
+    def _handle_tick(self, node_id, addr, packet):
         # consensus metronome sync message
-        if route[0] == "tick":
-            # which tick does the other client think we are up to
-            tick = self._parse_number_slot(packet)
-            # if the tick is higher than we expect at this point in time
-            if tick > self.last_tick[0]:
-                # jump to the new tick and reset our tick timer to this moment
-                self.last_tick = (tick, time.time())
-                # register the current new tick so we can run code
-                self.tick(*self.last_tick)
-                # send out our new tick anyway so everyone learns our last_message list
+        # which tick does the other client think we are up to
+        tick = self._parse_number_slot(packet, 2)
+        if tick is None:
+            return "No tick number"
+        now = self.clock()
+        tick_length = self._tick_length()
+        # when their tick actually started, allowing for the time it took to get here
+        their_tick_time = now - (self.get_node_latency(node_id) or 0)
+        # how far behind them we are (negative if we are ahead)
+        phase_error = self.last_tick[1] + (tick - self.last_tick[0]) * tick_length - their_tick_time
+        # if the tick is higher than we expect at this point in time, and too far ahead to catch up with smoothly
+        if tick > self.last_tick[0] and (tick > self.last_tick[0] + 1 or phase_error > TICK_SLEW_MAX * tick_length):
+            self.metrics.count("tick_jumps")
+            # jump to the new tick and reset our tick timer to when they started it
+            self.last_tick = (tick, their_tick_time)
+            self.tick_phase_error = [0.0, 0]
+            # register the current new tick so we can run code
+            self._notify(self.tick, *self.last_tick)
+            # send out our new tick anyway so everyone learns our last_message list
+            if self._tick_speaking(now):
                 self._broadcast_tick()
-            # remainder of the tick message is their state checksums
-            state_checksums = packet[:3]
-            # compare their state checksums to our own
-            if state_checksums != self.state_checksums:
-                logging.info("State checksums don't match, broadcasting state hash.");
-                # if we disagree about global state, broadcast what we think global state is
-                self._broadcast_state_ids()
-            # if this is the first time we have seen this node then run the callback method
-            if not self.last_seen.has_key(node_id):
-                self.node_joined(node_id)
-            # update the last seen time
-            self.last_seen[node_id] = time.time()
-        
+        elif node_id != self.node_id:
+            # the first time we hear the group, give the other nodes a moment to be heard too and then ask one for a snapshot
+            if self.snapshot is not None and self.snapshot.last_heard is None:
+                self.snapshot.last_heard = now
+                self._schedule(now + SNAPSHOT_ELECT_TIME, "snapshot-receive", None)
+            self._track_tick_offset(node_id, -phase_error)
+            # if we are only a little out of phase with them then move our phase towards theirs over the next few ticks
+            if abs(phase_error) <= TICK_SLEW_MAX * tick_length:
+                self.tick_phase_error[0] += phase_error
+                self.tick_phase_error[1] += 1
+        # remainder of the tick message is their state checksums
+        # (nodes that only subscribe to part of the state don't compare their own, and just repeat what they heard)
+        state_checksums = packet[3:6]
+        if state_checksums == NO_STATE_CHECKSUMS:
+            state_checksums = None
+        elif len(state_checksums) == 3 and node_id != self.node_id:
+            self.group_checksums = list(state_checksums)
+        # in scalable tick mode, keep track of whether the nodes chosen to speak, and the groups of speakers ahead of ours, still are
+        if self.tick_speakers and node_id != self.node_id:
+            epoch, place = self._tick_speaker_place()
+            rank = _speaker_rank(node_id, epoch)
+            chosen = rank <= self.tick_speaker_order[4]
+            if chosen:
+                self.tick_speaker_heard = now
+            if rank <= self.tick_speaker_order[5]:
+                self.tick_ahead_heard = now
+            # a node that isn't chosen only compares checksums with the nodes that are (or with whoever speaks up for them
+            # when they've gone quiet), so that one node that disagrees isn't answered by everybody
+            quiet = (now - self.tick_speaker_heard) / tick_length >= TICK_SPEAKER_TIMEOUT
+            if place >= self.tick_speakers and not chosen and not (quiet and rank < self.tick_speaker_order[2]):
+                state_checksums = None
+        # compare their state checksums to our own
+        if state_checksums and self.subscriptions is None and self.snapshot is None and state_checksums != self._get_state_checksums():
+            logging.info("State checksums don't match, broadcasting state digest.");
+            self.metrics.count("checksum_mismatches")
+            # if we disagree about global state, broadcast a summary of what we think global state is
+            self._broadcast_state_digest()
+            # and let everybody compare with our checksums at the next tick, even if it isn't our turn to speak
+            self.tick_disagreed = True
+        # update the last seen time
+        seen = not self.last_seen.has_key(node_id)
+        self.last_seen[node_id] = now
+        # if this is the first time we have seen this node then run the callback method
+        if seen:
+            # and start the timer that will forget them if they go quiet
+            self._schedule(now + NODE_TIMEOUT, "expire", node_id)
+            self._notify(self.node_joined, node_id)
+    
+    def _handle_ping(self, node_id, addr, packet):
+        # another node timing the round trip to us - answer straight away
+        if self._parse_number_slot(packet, 2) == self.node_id:
+            self._send_one_to_all("/pong", [self.node_id, node_id, self._parse_number_slot(packet, 3)])
+    
+    def _handle_pong(self, node_id, addr, packet):
+        # the answer to one of our pings
+        if self._parse_number_slot(packet, 2) == self.node_id:
+            self._track_pong(node_id, self._parse_number_slot(packet, 3), self.clock())
+    
+    def _handle_nack(self, node_id, addr, packet):
+        # another node asking for messages it missed
+        if self._parse_number_slot(packet, 2) == self.node_id:
+            self._resend_messages([m for m in packet[3:] if type(m) is int], self.clock())
+    
+    def _handle_leave(self, node_id, addr, packet):
         # message that a node has left the network
-        elif route[0] == "leave":
-            self._forget_old_nodes(time.time(), [node_id])
-        
+        self._forget_old_nodes(self.clock(), [node_id])
+    
+    def _handle_state_ids(self, node_id, addr, packet):
         # packet containing what another client thinks is current state
-        elif route[0] == "state-ids":
-            # build a list of their state unique id keys (node_id, message_id) 
-            their_state_keys = [tuple(packet[x:x+2]) for x in xrange(0, len(packet), 2)]
-            # find states they don't have, and which are older than 1 tick
-            for s in self.states:
-                if not tuple(self.states[s][:2]) in their_state_keys and self.states[s][2] + 1 < self.last_tick[0]:
-                    # rebroadcast the state message
-                    self._send_one_to_all("/state" + s, self.states[s])
-                    logging.info("Rebroadcasting state: %s = %s" % (s, self.states[s]))
-        
-        # packet updating client state or message
+        # a joining node being sent a snapshot will get these states from that
+        if self._snapshot_joining(node_id):
+            return
+        # build a set of their state unique id keys (node_id, message_id)
+        their_state_keys = set([tuple(packet[x:x+2]) for x in xrange(2, len(packet), 2)])
+        self._rebroadcast_missing_states(self.states.keys(), their_state_keys)
+        # a node that sends these (e.g. a Pd node) doesn't understand digests, so if it holds states we don't it needs
+        # our whole list of state ids to know which ones to send us
+        our_state_keys = set([(r.node_id, r.message_id) for k, r in self.states.items()])
+        if their_state_keys == our_state_keys:
+            # they hold exactly what we do, so nobody needs our list for a moment
+            self.state_answered[("/state-ids", 0, 0)] = self.clock()
+        elif self.subscriptions is None and self.snapshot is None and their_state_keys - our_state_keys:
+            self._broadcast_state_ids()
+    
+    def _handle_state_digest(self, node_id, addr, packet):
+        # packet containing another client's digests of the children of one state bucket
+        # (our partial state table would disagree with everyone, so we leave this to the nodes holding all of it)
+        if self.subscriptions is not None or self._snapshot_joining(node_id):
+            return
+        level = self._parse_number_slot(packet, 2)
+        prefix = self._parse_number_slot(packet, 3)
+        if level is None or prefix is None or not 0 <= level < STATE_BUCKET_DEPTH:
+            return "Bad state digest bucket"
+        idx = 4
+        agree = True
+        for child in self._bucket_children(level, prefix):
+            their_bucket = packet[idx:idx + 2]
+            idx += 2
+            bucket = self.state_buckets[level + 1].get(child, [0, ()])
+            # only look further into the buckets where we disagree
+            if their_bucket != [len(bucket[1]), bucket[0]]:
+                agree = False
+                if level + 1 == STATE_BUCKET_DEPTH or len(bucket[1]) <= STATE_BUCKET_IDS_MAX:
+                    # small enough to just tell them exactly which states we hold in there
+                    self._broadcast_bucket_state_ids(level + 1, child)
+                else:
+                    self._broadcast_state_digest(level + 1, child)
+        # a digest just like ours is already out there, so nobody needs ours for a moment
+        if agree:
+            self.state_answered[("/state-digest", level, prefix)] = self.clock()
+    
+    def _handle_state_bucket_ids(self, node_id, addr, packet):
+        # packet containing what another client thinks is current state within one bucket
+        level = self._parse_number_slot(packet, 2)
+        prefix = self._parse_number_slot(packet, 3)
+        if level is None or prefix is None or not 0 <= level <= STATE_BUCKET_DEPTH:
+            return "Bad state bucket"
+        if self._snapshot_joining(node_id):
+            return
+        their_state_keys = set([tuple(packet[x:x+2]) for x in xrange(4, len(packet), 2)])
+        keys = self.state_buckets[level].get(prefix, [0, ()])[1]
+        self._rebroadcast_missing_states(keys, their_state_keys)
+        # they hold exactly what we do in this bucket, so nobody needs our list of it for a moment
+        if their_state_keys == set([(r.node_id, r.message_id) for r in [self.states.get(s) for s in keys]]):
+            self.state_answered[("/state-bucket-ids", level, prefix)] = self.clock()
+    
+    def _handle_state(self, node_id, addr, packet):
+        # packet updating client state
+        # every message should contain a message id
+        message_id = self._parse_number_slot(packet, 2)
+        if message_id is None:
+            return "No message_id"
+        # notice (and ask for) any messages from this node we missed along the way
+        self._track_message_id(node_id, message_id, self.clock())
+        self._apply_state(node_id, addr, message_id, packet)
+    
+    def _apply_state(self, node_id, addr, message_id, packet, restoring=False):
+        # with state messages, we only really care about timestamp - just want the latest
+        # when was this state change according to consensus clock
+        tick = self._parse_number_slot(packet, 3)
+        timediff = self._parse_number_slot(packet, 4, convert=float)
+        # what key the state change is stored on
+        # (interned so that each address is only held in memory once however many tables it is in)
+        key = intern(addr[self.state_address_start:])
+        # tick, time_offset, value
+        old_state = self.states.get(key)
+        if old_state is None or self._state_wins(old_state, tick, timediff, node_id):
+            # copy the value out of the packet
+            value = tuple(packet[5:])
+            new_state = StateRecord(node_id, message_id, tick, timediff, value)
+            self.states.set(key, new_state)
+            if not restoring:
+                # run the state change callbacks
+                for callback in self._dispatch(addr):
+                    self._notify(callback or self.state, node_id, key, *value)
+                # and remember it for if we restart
+                if self.state_log:
+                    self.state_log.append(self.codec.encode("/state" + key, new_state.message()))
+            # update our state checksums
+            self._update_state_checksums(old_state, new_state)
+            self._update_state_buckets(key, old_state, new_state)
+        elif (old_state.node_id, old_state.message_id) == (node_id, message_id):
+            # somebody else has just rebroadcast the state we hold, so we don't need to
+            self.state_resent[key] = self.clock()
+    
+    def _handle_state_delta(self, node_id, addr, packet):
+        # packet changing some of the items of a list state, based on a particular earlier version of it
+        message_id = self._parse_number_slot(packet, 2)
+        if message_id is None:
+            return "No message_id"
+        self._track_message_id(node_id, message_id, self.clock())
+        tick, base_node_id, base_message_id, length = [self._parse_number_slot(packet, x) for x in (3, 5, 6, 7)]
+        timediff = self._parse_number_slot(packet, 4, convert=float)
+        if None in (tick, timediff, base_node_id, base_message_id, length) or length < 0:
+            return "Bad state delta"
+        key = addr[self.state_delta_address_start:]
+        state_addr = self.namespace + "/state" + key
+        current = self.states.get(key)
+        # nothing to do if we already hold something newer
+        if current is not None and not self._state_wins(current, tick, timediff, node_id):
+            return
+        value = None
+        if current is not None and current.node_id == base_node_id and current.message_id == base_message_id:
+            # patch the changed items into the version it was based on
+            value = list(current.value[:length]) + [None] * (length - len(current.value))
+            for x in xrange(8, len(packet) - 1, 2):
+                if type(packet[x]) is not int or not 0 <= packet[x] < length:
+                    return "Bad state delta"
+                value[packet[x]] = packet[x + 1]
+        elif node_id == self.node_id and self.delta_sent.get(key, [[0, 0]])[0][1] == message_id:
+            # our own delta came back but somebody else's change got in first - we know what we sent
+            value = self.delta_sent[key][0][4:]
+        if value is None or None in value:
+            # we don't hold the version it was based on, so ask the node that sent it for the whole value
+            self.metrics.count("state_delta_misses")
+            self._send_one_to_all("/state-request", [self.node_id, node_id, key])
+            return
+        self.metrics.count("state_deltas_applied")
+        self._apply_state(node_id, state_addr, message_id, [PROTOCOL_VERSION, node_id, message_id, tick, timediff] + value)
+    
+    def _handle_state_request(self, node_id, addr, packet):
+        # another node couldn't apply one of our deltas - send the whole value the last one we sent for that address left it at
+        if self._parse_number_slot(packet, 2) != self.node_id or len(packet) < 4:
+            return
+        sent = self.delta_sent.get(packet[3])
+        now = self.clock()
+        # (several nodes may ask at once)
+        if sent and sent[1] + NACK_SUPPRESS_TIME < now:
+            sent[1] = now
+            self._send_one_to_all("/state" + packet[3], sent[0])
+            self.metrics.count("state_requests_answered")
+    
+    def _handle_snapshot_request(self, node_id, addr, packet):
+        # a joining node asking one of us for a snapshot of the state table, or for the chunks of it that it lost
+        now = self.clock()
+        self.snapshot_joiners[node_id] = now
+        # only the node it chose answers, and only if it holds the whole state table itself
+        if self._parse_number_slot(packet, 2) != self.node_id or self.subscriptions is not None or self.snapshot is not None:
+            return
+        transfer_id = self._parse_number_slot(packet, 3)
+        transfer = self.snapshot_transfers.get(node_id)
+        if transfer is None or transfer[0] != transfer_id:
+            # a new snapshot - compress the whole state table into chunks as it is right now
+            # (states that change after this are broadcast as usual)
+            chunks = self._snapshot_chunks()
+            transfer = self.snapshot_transfers[node_id] = [self.snapshot_ids.next(), chunks, [], now]
+            missing = range(len(chunks))
+            logging.info("Sending node %d a snapshot of %d states in %d chunks", node_id, len(self.states), len(chunks))
         else:
-            # every message should contain a message id
-            message_id = self._parse_number_slot(packet)
-            # with state messages, we only really care about timestamp - just want the latest
-            if route[0] == "state":
-                # when was this state change according to consensus clock
-                tick = self._parse_number_slot(packet)
-                timediff = self._parse_number_slot(packet, convert=float)
-                # what key the state change is stored on
-                key = "/" + "/".join(route[1:])
-                # tick, time_offset, value
-                if not self.states.has_key(key) or self.states[key][2] < tick or (self.states[key][2] == tick and self.states[key][3] < timediff) or (self.states[key][2] == tick and self.states[key][3] == timediff and self.states[key][0] < node_id):
-                    self.states[key] = [node_id, message_id, tick, timediff, packet]
-                    # run the state change callback
-                    self.state(node_id, key, *packet)
-                    # update our state checksums
-                    self._update_state_checksums()
-    
-    def _send_one_to_all(self, address, message):
-        # set up the new OSC message to be sent out
-        oscmsg = OSC.OSCMessage()
-        oscmsg.setAddress(self.namespace + address)
-        # add the version number first
-        oscmsg.append(PROTOCOL_VERSION)
-        # add the message parts to it
-        [oscmsg.append(m) for m in message]
-        logging.debug("raw sent packet %s" % (oscmsg,))
-        # send one message out to all broadcast/multicast networks possible, ignoring errors
-        for a in ADDRESSES:
-            try:
-                return self.sender.sendto(oscmsg, (ADDRESSES[a], self.port))
-            except OSC.OSCClientError, e:
-                # silently drop socket errors because we'll just keep trying
-                # TODO: log
-                logging.warning("Dropped message send:")
-                logging.warning(oscmsg)
-                logging.warning(e)
+            # lost chunks of the snapshot we already sent
+            missing = [m for m in packet[4:] if type(m) is int and 0 <= m < len(transfer[1]) and not m in transfer[2]]
+        if missing and not transfer[2]:
+            self._schedule(now, "snapshot-send", node_id)
+        transfer[2] += missing
+        transfer[3] = now
+    
+    def _handle_snapshot(self, node_id, addr, packet):
+        # one compressed chunk of a snapshot of the state table
+        joiner_id = self._parse_number_slot(packet, 2)
+        now = self.clock()
+        if joiner_id != self.node_id:
+            # somebody else's snapshot - keep leaving their digests alone while it arrives
+            self.snapshot_joiners[joiner_id] = now
+            return
+        snapshot = self.snapshot
+        transfer_id, chunk, total = [self._parse_number_slot(packet, x) for x in (3, 4, 5)]
+        if snapshot is None or node_id != snapshot.node_id or (snapshot.transfer_id and transfer_id != snapshot.transfer_id):
+            return
+        if None in (transfer_id, chunk, total) or len(packet) < 7:
+            return "Bad snapshot chunk"
+        snapshot.transfer_id = transfer_id
+        snapshot.total = total
+        snapshot.last_heard = now
+        if chunk in snapshot.received:
+            return
+        snapshot.received.add(chunk)
+        self.metrics.count("snapshot_chunks_received")
+        # each chunk is a compressed bundle of the original /state messages
+        try:
+            data = zlib.decompress(packet[6])
+        except zlib.error:
+            return "Bad snapshot chunk"
+        self.codec.decode(data, self._handle_snapshot_state)
+        if len(snapshot.received) >= total:
+            logging.info("Received a snapshot of %d states from node %d", len(self.states), node_id)
+            self.metrics.count("snapshots_received")
+            self.snapshot = None
+    
+    def _handle_snapshot_state(self, addr, tags, packet, source, restoring=False):
+        # a state from a snapshot chunk - applied like any other state, but without tracking its message id
+        # (its author sent it long ago, so it says nothing about which of their recent messages we have seen)
+        node_id = self._parse_number_slot(packet, 1)
+        message_id = self._parse_number_slot(packet, 2)
+        if node_id and message_id is not None and addr.startswith(self.namespace + "/state/") and self._dispatch(addr):
+            self._apply_state(node_id, addr, message_id, packet, restoring)
+    
+    def _restore_state(self, addr, tags, packet, source):
+        # a state from our own state log - quietly put back into the table while the node is being created
+        self._handle_snapshot_state(addr, tags, packet, source, restoring=True)
+    
+    def _state_wins(self, current, tick, timediff, node_id):
+        # whether a state set at (tick, timediff) by node_id replaces the current record - the latest wins, ties go to the highest node id
+        return current.tick < tick or (current.tick == tick and current.timediff < timediff) or (current.tick == tick and current.timediff == timediff and current.node_id < node_id)
+    
+    def _handle_message(self, node_id, addr, packet):
+        # every message should contain a message id
+        message_id = self._parse_number_slot(packet, 2)
+        if message_id is None:
+            return "No message_id"
+        # ephemeral messages are delivered once each
+        if self._track_message_id(node_id, message_id, self.clock()):
+            address = addr[len(self.namespace):]
+            for callback in self._dispatch(addr):
+                self._notify(callback or self.message, node_id, address, *packet[3:])
+    
+    def _dispatch(self, addr):
+        # which callbacks (None meaning the state/message method) an incoming OSC address should go to
+        # - nothing if we haven't subscribed to it, and everything that isn't a state or regular message goes to the protocol
+        dispatch = self.dispatch_cache.get(addr)
+        if dispatch is None:
+            # keep the cache bounded however many different addresses turn up
+            if len(self.dispatch_cache) >= DISPATCH_CACHE_SIZE:
+                self.dispatch_cache.clear()
+            dispatch = self.dispatch_cache[addr] = self._compile_dispatch(addr)
+        return dispatch
+    
+    def _compile_dispatch(self, addr):
+        if self.subscriptions is None or not addr.startswith(self.namespace + "/"):
+            return (None,)
+        address = addr[len(self.namespace):]
+        route = address[1:].split("/", 1)[0]
+        if route == "state" or route == "state-delta":
+            address = address[len(route) + 1:]
+            # everybody needs the BPM to keep time
+            if address == "/BPM":
+                return (None,)
+        elif route in self.routes:
+            return (None,)
+        callbacks = []
+        for callback in self.subscriptions.match(address):
+            if not callback in callbacks:
+                callbacks.append(callback)
+        return tuple(callbacks)
+    
+    def _accept_address(self, addr):
+        # transports call this as soon as each address is decoded, so that packets nobody subscribed to are dropped before their arguments are parsed
+        if self._dispatch(addr):
+            return True
+        if self.metrics.enabled:
+            self.metrics.count("drops.Not subscribed")
+        return False
+    
+    def _send_one_to_all(self, address, message, bundle=False):
+        # encode the new OSC message to be sent out
+        data = self.codec.encode(address, message)
+        if self.metrics.enabled:
+            route = address[1:].split("/", 1)[0]
+            self.metrics.count("packets_out." + (route in self.routes and route or "message"))
+        # hold on to it if it can go out in a bundle with others at the end of this poll
+        if bundle and self.bundle_states:
+            self.outgoing_bundle.append(data)
+            self.metrics.count("states_bundled")
+        else:
+            self._transmit(data)
+    
+    def _flush_bundle(self):
+        # take the waiting messages first in case more are added from another thread
+        outgoing, self.outgoing_bundle = self.outgoing_bundle, []
+        # a lone message doesn't need to be wrapped in a bundle
+        if len(outgoing) == 1:
+            return self._transmit(outgoing[0])
+        # pack waiting messages into as few bundles as will fit in a datagram each
+        bundle = []
+        # "#bundle" and the time tag
+        size = len(OSC_BUNDLE_HEADER)
+        for data in outgoing:
+            # bundle elements are prefixed with their length
+            if bundle and size + len(data) + 4 > MAX_BUNDLE_SIZE:
+                self._transmit(self.codec.encode_bundle(bundle))
+                bundle = []
+                size = len(OSC_BUNDLE_HEADER)
+            bundle.append(data)
+            size += len(data) + 4
+        if bundle:
+            self._transmit(self.codec.encode_bundle(bundle))
+    
+    def _transmit(self, data):
+        if self.metrics.enabled:
+            self.metrics.count("datagrams_out")
+            self.metrics.count("bytes_out", len(data))
+        self.transport.send(data)
+    
+    def _export_metrics(self):
+        # send a JSON snapshot of our metrics to the local metrics address (e.g. a monitoring script)
+        try:
+            snapshot = self.metrics.snapshot()
+            snapshot["node_id"] = self.node_id
+            self.metrics_socket.sendto(json.dumps(snapshot), self.metrics_address)
+        except socket.error, e:
+            logging.debug("Couldn't export metrics: %s", e)
     
     ### Utility methods. ###
     
@@ -388,60 +1451,759 @@ class SyncjamsNode:
         # s._array_checksum([12, 432, 3, 0, 2343]) == 28632
         # s._array_checksum([0.223, 4234, 0.242435, .76653, 3, 23.35, 656, 43]) == 37187
         # s._array_checksum([122112, 4321, 123, 11, 14, 4, 43, 8388606, 3, 432, 545]) == 36600
-        h = 5381
+        h = CHECKSUM_SEED
         for v in values:
-            h = ((int(int(33 * h) % 65535) ^ int(v % 65535)) % 65535)
+            h = _checksum_step(h, v)
         return h
     
     def _tick_length(self):
         try:
-            bpm = float(self.states["/BPM"][-1][0])
+            bpm = float(self.states.get("/BPM").value[0])
         except ValueError:
             bpm = 180
         except IndexError:
             bpm = 180
+        except AttributeError:
+            bpm = 180
         return 60.0 / bpm
     
     def _parse_number_slot(self, packet, idx=0, convert=int):
         try:
-            return convert(packet.pop(idx))
+            return convert(packet[idx])
         except ValueError:
             pass
+        except TypeError:
+            pass
         except IndexError:
             pass
     
     def _drop(self, message, addr, tags, packet, source, route=None):
-        logging.debug("DROPPED (%s) from %s" % (message, OSC.getUrlStr(source)))
-        logging.debug("\taddr: %s" % addr)
-        logging.debug("\ttypetags: %s" % tags)
-        logging.debug("\tdata: %s" % packet)
-        if route:
-            logging.debug("\troute: %s" % route)
-    
-    def _make_sender(self):
-        # OSCClient that sends with broadcast flags on from any assigned port
-        sender = OSC.OSCClient()
-        sender.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sender.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        sender.socket.bind((ANY, 0))
-        sender.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
-        return sender
+        if self.metrics.enabled:
+            self.metrics.count("drops." + message)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("DROPPED (%s) from %s", message, OSC.getUrlStr(source))
+            logging.debug("\taddr: %s", addr)
+            logging.debug("\ttypetags: %s", tags)
+            logging.debug("\tdata: %s", packet)
+            if route:
+                logging.debug("\troute: %s", route)
 
 class SyncjamsException(Exception):
     pass
 
+def _monotonic_clock():
+    # a clock that never jumps backwards or forwards when the wall clock is set (NTP, the user changing the time, etc.)
+    # python 3 has one built in, on python 2 we ask the C library for CLOCK_MONOTONIC ourselves
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    try:
+        import ctypes
+        import ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        libc = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"))
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        # CLOCK_MONOTONIC is 6 on OSX and 1 on Linux and the BSDs
+        clock_id = sys.platform == "darwin" and 6 or 1
+        now = timespec()
+        def monotonic():
+            if clock_gettime(clock_id, ctypes.byref(now)):
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return now.tv_sec + now.tv_nsec * 1e-9
+        # make sure it actually works here before we rely on it
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError, TypeError):
+        logging.warning("No monotonic clock available, falling back to time.time().")
+        return time.time
+
+# default clock for SyncjamsNode - seconds since some arbitrary point that only ever moves forwards
+monotonic = _monotonic_clock()
+
+# starting value of the djb2 style state checksum
+CHECKSUM_SEED = 5381
+
+def _checksum_step(h, v):
+    # fold one more value into the djb2 style checksum - see SyncjamsNode._array_checksum
+    return ((int(int(33 * h) % 65535) ^ int(v % 65535)) % 65535)
+
+def _address_hash(address):
+    # djb2 over the address with a murmur3 style finaliser so that similar addresses spread across buckets
+    h = 5381
+    for c in address:
+        h = ((h * 33) ^ ord(c)) & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+def _speaker_rank(node_id, epoch):
+    # a node's place in the running to broadcast ticks during an epoch - the same on every node, and reshuffled every epoch
+    h = ((int(node_id) * 0x9e3779b1) ^ (int(epoch) * 0x85ebca6b)) & 0xffffffff
+    h ^= h >> 16
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 13
+    return h
+
+def _bucket_prefix(key_hash, level):
+    # the bucket an address hash falls into at a particular level (level 0 is the root bucket)
+    return int(key_hash >> (32 - STATE_BUCKET_BITS * level))
+
+def _state_entry_hash(key_hash, node_id, message_id):
+    # hash of a single state's identity - xored together to give an order independent bucket digest
+    # (kept to 31 bits so that it fits in an OSC int)
+    return int((((key_hash ^ (int(node_id) * 0x9e3779b1)) * 0x85ebca6b) ^ (int(message_id) * 0xc2b2ae35)) & 0x7fffffff)
+
+class SortedChecksum:
+    """
+        Sorted column of values kept up to date one insert/remove at a time, with a cache of the running
+        checksum at every position so only the part of the column after the lowest change is re-folded.
+        Gives exactly the same result as _array_checksum(sorted(values)) so it stays wire compatible.
+    """
+    def __init__(self):
+        self.values = []
+        # prefix[i] is the checksum of values[:i + 1]
+        self.prefix = []
+        # lowest index that has changed since we last folded the checksum (None when clean)
+        self.dirty = None
+    
+    def add(self, value):
+        idx = bisect_left(self.values, value)
+        self.values.insert(idx, value)
+        self._touch(idx)
+    
+    def remove(self, value):
+        idx = bisect_left(self.values, value)
+        if idx < len(self.values) and self.values[idx] == value:
+            del self.values[idx]
+            self._touch(idx)
+    
+    def replace(self, old, new):
+        if old is not None:
+            self.remove(old)
+        if new is not None:
+            self.add(new)
+    
+    def checksum(self):
+        if self.dirty is not None:
+            # throw away the cached running checksum after the first changed value and re-fold the rest
+            del self.prefix[self.dirty:]
+            h = self.prefix[-1] if self.prefix else CHECKSUM_SEED
+            for v in self.values[self.dirty:]:
+                h = _checksum_step(h, v)
+                self.prefix.append(h)
+            self.dirty = None
+        return self.prefix[-1] if self.prefix else CHECKSUM_SEED
+    
+    def _touch(self, idx):
+        if self.dirty is None or idx < self.dirty:
+            self.dirty = idx
+
+class StateRecord(object):
+    """ One entry in the state table - which node set it, with which message, when (tick, time_offset), and the value. """
+    __slots__ = ("node_id", "message_id", "tick", "timediff", "value")
+    
+    def __init__(self, node_id, message_id, tick, timediff, value):
+        self.node_id = node_id
+        self.message_id = message_id
+        self.tick = tick
+        self.timediff = timediff
+        # tuple of the state's OSC arguments
+        self.value = value
+    
+    def get_value(self):
+        # a single value on its own, otherwise a list of the values
+        return self.value[0] if len(self.value) == 1 else list(self.value)
+    
+    def message(self):
+        # the arguments of the /state message that set this record (after the node_id)
+        return [self.node_id, self.message_id, self.tick, self.timediff] + list(self.value)
+    
+    def __repr__(self):
+        return "StateRecord(%r, %r, %r, %r, %r)" % (self.node_id, self.message_id, self.tick, self.timediff, self.value)
+
+class StateStore:
+    """
+        Table of state address -> StateRecord with the addresses also kept in sorted order,
+        so that all the addresses under a prefix can be found in time proportional to how many there are.
+        Addresses should be interned by the caller so each one is only held in memory once.
+    """
+    def __init__(self):
+        self.records = {}
+        # every address we hold, in sorted order
+        self.addresses = []
+    
+    def __len__(self):
+        return len(self.records)
+    
+    def __contains__(self, address):
+        return address in self.records
+    
+    def get(self, address, default=None):
+        return self.records.get(address, default)
+    
+    def set(self, address, record):
+        """ Store a record, returning the one it replaced (or None). """
+        old = self.records.get(address)
+        if old is None:
+            insort(self.addresses, address)
+        self.records[address] = record
+        return old
+    
+    def keys(self, prefix=""):
+        """ Sorted list of the addresses starting with prefix. """
+        return self.addresses[self._start(prefix):self._end(prefix)]
+    
+    def items(self, prefix=""):
+        """ Sorted list of (address, record) for the addresses starting with prefix. """
+        records = self.records
+        return [(address, records[address]) for address in self.keys(prefix)]
+    
+    def _start(self, prefix):
+        return bisect_left(self.addresses, prefix)
+    
+    def _end(self, prefix):
+        # the first address after all those starting with prefix
+        # (byte 255 never appears in ascii or utf-8, so nothing starting with prefix sorts after prefix + chr(255))
+        return prefix and bisect_left(self.addresses, prefix + chr(255)) or len(self.addresses)
+
+def _compile_osc_pattern(segment):
+    # regular expression for one /-separated part of an OSC address pattern:
+    # ? any character, * any run of characters, [abc] [a-z] [!abc] character sets, {foo,bar} alternatives
+    regex = ""
+    i = 0
+    while i < len(segment):
+        c = segment[i]
+        if c == "*":
+            regex += ".*"
+        elif c == "?":
+            regex += "."
+        elif c == "[":
+            end = segment.find("]", i + 1)
+            if end < 0:
+                raise SyncjamsException("Unterminated '[' in OSC address pattern '%s'." % segment)
+            chars = segment[i + 1:end]
+            negate = chars.startswith("!")
+            regex += "[" + (negate and "^" or "") + chars[negate and 1 or 0:].replace("\\", "\\\\").replace("^", "\\^") + "]"
+            i = end
+        elif c == "{":
+            end = segment.find("}", i + 1)
+            if end < 0:
+                raise SyncjamsException("Unterminated '{' in OSC address pattern '%s'." % segment)
+            regex += "(?:" + "|".join([re.escape(a) for a in segment[i + 1:end].split(",")]) + ")"
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex + "\\Z")
+
+class StateLog:
+    """
+        The winning /state messages a node has seen, appended to a file as they happen and replayed when the node
+        is next created. Once the log has grown big enough the whole state table is written to a snapshot file
+        (path + ".snapshot") instead and the log starts again, so replay time stays proportional to the number of states.
+        Both files are OSC bundles of encoded /state messages, so a record torn by a crash is simply dropped.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.log = None
+        self.size = 0
+        self.snapshot_size = 0
+        # whether we have appended anything since the last flush
+        self.dirty = False
+    
+    def replay(self, codec, callback):
+        """ Decode every state in the snapshot and then the log, running callback(address, typetags, args, source) for each. Returns how many there were. """
+        replayed = 0
+        if os.path.exists(self.snapshot_path):
+            replayed, self.snapshot_size = self._replay_file(self.snapshot_path, codec, callback)
+        log_count = 0
+        good = 0
+        if os.path.exists(self.path):
+            log_count, good = self._replay_file(self.path, codec, callback)
+        # carry on appending after the last complete record (throwing away anything torn by a crash)
+        self.log = open(self.path, good and "r+b" or "w+b")
+        if not good:
+            self.log.write(OSC_BUNDLE_HEADER)
+        self.log.seek(good or len(OSC_BUNDLE_HEADER))
+        self.log.truncate()
+        self.log.flush()
+        self.size = self.log.tell()
+        return replayed + log_count
+    
+    def append(self, message):
+        self.log.write(OSC_INT.pack(len(message)) + message)
+        self.size += 4 + len(message)
+        self.dirty = True
+    
+    def flush(self):
+        if self.dirty:
+            self.log.flush()
+            self.dirty = False
+    
+    def needs_compacting(self):
+        return self.size > STATE_LOG_COMPACT_SIZE and self.size > self.snapshot_size
+    
+    def compact(self, messages):
+        """ Replace the snapshot with messages (every current state) and empty the log. """
+        temporary = self.snapshot_path + ".tmp"
+        snapshot = open(temporary, "wb")
+        snapshot.write(OSC_BUNDLE_HEADER)
+        for message in messages:
+            snapshot.write(OSC_INT.pack(len(message)) + message)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+        self.snapshot_size = snapshot.tell()
+        snapshot.close()
+        # (crashing before the log is emptied just means the log's states are replayed over the snapshot's again)
+        if os.name == "nt" and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+        os.rename(temporary, self.snapshot_path)
+        self.log.seek(len(OSC_BUNDLE_HEADER))
+        self.log.truncate()
+        self.log.flush()
+        self.size = self.log.tell()
+        self.dirty = False
+    
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+    
+    def _replay_file(self, path, codec, callback):
+        # returns (records_replayed, offset_after_the_last_good_record)
+        f = open(path, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size < len(OSC_BUNDLE_HEADER):
+                return 0, 0
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            if data[:len(OSC_BUNDLE_HEADER)] != OSC_BUNDLE_HEADER:
+                logging.warning("Ignoring state log %s which is not an OSC bundle", path)
+                return 0, 0
+            replayed = 0
+            offset = len(OSC_BUNDLE_HEADER)
+            while offset + 4 <= len(data):
+                length = OSC_INT.unpack_from(data, offset)[0]
+                if length < 0 or offset + 4 + length > len(data):
+                    break
+                try:
+                    codec.decode(data, callback, None, offset + 4, offset + 4 + length)
+                except (SyncjamsException, struct.error, ValueError, IndexError), e:
+                    logging.warning("Stopped replaying state log %s at a bad record: %r", path, e)
+                    break
+                replayed += 1
+                offset += 4 + length
+            return replayed, offset
+        finally:
+            data.close()
+
+class SnapshotTransfer:
+    """ A joining node's progress receiving a snapshot of the state table from another node. """
+    def __init__(self):
+        # the node we asked for it, and the id it gave this snapshot (0 until the first chunk arrives)
+        self.node_id = None
+        self.transfer_id = 0
+        # number of chunks in the snapshot and which of them we have
+        self.total = None
+        self.received = set()
+        # every node we have asked so far
+        self.asked = []
+        # when we asked or last got a chunk (None until we first hear the group)
+        self.last_heard = None
+    
+    def start(self, node_id, now):
+        # ask a (different) node from scratch
+        self.node_id = node_id
+        self.transfer_id = 0
+        self.total = None
+        self.received = set()
+        self.asked.append(node_id)
+        self.last_heard = now
+
+class AddressPatternTrie:
+    """
+        OSC address patterns stored a /-separated part at a time, each holding a list of values (e.g. callbacks).
+        Plain parts are looked up in a dict and only the parts with wildcards are matched one by one,
+        so matching an address only visits the branches that could match it.
+    """
+    def __init__(self):
+        self.root = self._branch()
+        self.size = 0
+    
+    def __len__(self):
+        return self.size
+    
+    def add(self, pattern, value):
+        branch = self.root
+        for part in pattern.split("/")[1:]:
+            if [c for c in "*?[{" if c in part]:
+                for wildcard, regex, child in branch[1]:
+                    if wildcard == part:
+                        break
+                else:
+                    child = self._branch()
+                    branch[1].append((part, _compile_osc_pattern(part), child))
+            else:
+                child = branch[0].get(part)
+                if child is None:
+                    child = branch[0][part] = self._branch()
+            branch = child
+        branch[2].append(value)
+        self.size += 1
+    
+    def remove(self, pattern, value):
+        # (emptied branches are left in place - patterns tend to be re-subscribed)
+        branch = self.root
+        for part in pattern.split("/")[1:]:
+            branch = branch[0].get(part) or dict([(w, child) for w, regex, child in branch[1]]).get(part)
+            if branch is None:
+                return
+        if value in branch[2]:
+            branch[2].remove(value)
+            self.size -= 1
+    
+    def match(self, address):
+        """ Returns the values of every pattern matching the address. """
+        branches = [self.root]
+        for part in address.split("/")[1:]:
+            matched = []
+            for branch in branches:
+                child = branch[0].get(part)
+                if child is not None:
+                    matched.append(child)
+                for wildcard, regex, child in branch[1]:
+                    if regex.match(part):
+                        matched.append(child)
+            branches = matched
+            if not branches:
+                return []
+        return sum([branch[2] for branch in branches], [])
+    
+    def _branch(self):
+        # [{plain_part: branch}, [(wildcard_part, regex, branch)], values]
+        return [{}, [], []]
+
+class EventQueue:
+    """
+        Fixed size queue of (function, args) calls from one producer thread to one consumer thread.
+        The slots are allocated up front, and only the producer moves the tail while only the consumer moves the head,
+        so neither side ever waits on a lock. Finished slots are overwritten (and their arguments freed) by the producer.
+        With shared=True any number of producer threads may put() - they take turns with a lock, but the consumer still doesn't.
+    """
+    def __init__(self, size, shared=False):
+        self.size = size
+        # lock the producers take turns to fill in a slot and move the tail with (None when there is only one)
+        self.producer_lock = shared and threading.Lock() or None
+        self.functions = [None] * size
+        self.arguments = [None] * size
+        # count of calls taken out and put in so far (slot = count % size)
+        self.head = 0
+        self.tail = 0
+    
+    def __len__(self):
+        return self.tail - self.head
+    
+    def put(self, function, args):
+        """ Queue up function(*args) from the producer thread. Returns False if the queue is full. """
+        if self.producer_lock is None:
+            return self._put(function, args)
+        with self.producer_lock:
+            return self._put(function, args)
+    
+    def _put(self, function, args):
+        tail = self.tail
+        if tail - self.head >= self.size:
+            return False
+        slot = tail % self.size
+        self.functions[slot] = function
+        self.arguments[slot] = args
+        # the consumer only sees the call once its slot has been filled in
+        self.tail = tail + 1
+        return True
+    
+    def run(self, limit=None):
+        """ Make up to limit of the queued calls, in order, from the consumer thread. Returns how many were made. """
+        head = self.head
+        end = self.tail
+        if limit is not None:
+            end = min(end, head + limit)
+        ran = end - head
+        while head < end:
+            slot = head % self.size
+            function = self.functions[slot]
+            args = self.arguments[slot]
+            # hand the slot back before the call so a call that raises isn't made again
+            head += 1
+            self.head = head
+            try:
+                function(*args)
+            except Exception, e:
+                logging.warning("Error in queued call to %s: %r", getattr(function, "__name__", function), e)
+        return ran
+
+class SyncjamsMetrics:
+    """
+        Cheap counters plus latency histograms with power-of-two microsecond buckets.
+        Nothing is counted or timed unless enabled is True (the node skips the work of naming per-packet counters too).
+    """
+    # bucket i counts timings under 2^i microseconds (the last bucket takes everything bigger)
+    buckets = 24
+    
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.counters = {}
+        # name -> [count, sum, max, bucket_counts]
+        self.histograms = {}
+    
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [0, 0.0, 0.0, [0] * self.buckets]
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[2] = max(histogram[2], seconds)
+        histogram[3][min(int(seconds * 1e6).bit_length(), self.buckets - 1)] += 1
+    
+    def snapshot(self):
+        """ Returns a copy of the counters and histograms as plain dicts. """
+        histograms = {}
+        for name, (count, total, maximum, buckets) in self.histograms.items():
+            histograms[name] = {
+                "count": count,
+                "sum": total,
+                "max": maximum,
+                "buckets": dict([(1 << b, c) for b, c in enumerate(buckets) if c]),
+            }
+        return {"counters": self.counters.copy(), "histograms": histograms}
+    
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+# OSC argument packers
+OSC_INT = struct.Struct(">i")
+OSC_FLOAT = struct.Struct(">f")
+# "#bundle" followed by the "immediately" time tag
+OSC_BUNDLE_HEADER = "#bundle\0" + struct.pack(">II", 0, 1)
+
+def _osc_string(value):
+    # null terminated and padded to a multiple of four bytes
+    value = str(value)
+    return value + "\0" * (4 - len(value) % 4)
+
+def _osc_blob(value):
+    # length prefixed and padded to a multiple of four bytes
+    return OSC_INT.pack(len(value)) + str(value) + "\0" * (-len(value) % 4)
+
+# struct formats of the fixed size OSC argument types we decode natively (64 bit "h" ints come out as Python ints/longs)
+OSC_NUMERIC_TAGS = {"i": "i", "f": "f", "d": "d", "h": "q"}
+# OSC argument types that carry no data
+OSC_CONSTANT_TAGS = {"T": True, "F": False, "N": None}
+
+def _osc_padded(length):
+    # length of a null terminated string of this many characters once padded
+    return (length // 4 + 1) * 4
+
+class SyncjamsCodec:
+    """
+        Struct based OSC encoder/decoder for the messages SyncJams sends at high rates (/tick, /state).
+        Outgoing messages reuse a cached, pre-padded address + type tag + protocol version prefix and a
+        precompiled struct for the numeric arguments of each address/type combination seen. Incoming
+        datagrams are decoded straight out of the receive buffer into a reusable argument list.
+        Messages with argument types the fast path doesn't know are handed to pyOSC to decode.
+    """
+    # forget cached prefixes once we have this many, so an unbounded number of addresses can't eat memory
+    cache_size = 4096
+    
+    def __init__(self, namespace=NAMESPACE, version=PROTOCOL_VERSION):
+        self.namespace = namespace
+        self.version = version
+        # (address, typetags) -> (prefix, numeric_struct)
+        self.encoders = {}
+        # typetags -> list of (typetag, numeric_struct) runs to decode
+        self.decoders = {}
+    
+    def encode(self, address, args):
+        """ Returns the binary OSC message for namespace + address carrying the protocol version followed by args (bytearrays are sent as blobs). """
+        tags = ""
+        for a in args:
+            t = type(a)
+            if t is int or t is long:
+                tags += "i"
+            elif t is float:
+                tags += "f"
+            elif t is bytearray:
+                tags += "b"
+            else:
+                tags += "s"
+        encoder = self.encoders.get((address, tags))
+        if encoder is None:
+            encoder = self._compile(address, tags)
+        prefix, numeric = encoder
+        if numeric:
+            return prefix + numeric.pack(*args)
+        parts = [prefix]
+        for t, a in zip(tags, args):
+            if t == "i":
+                parts.append(OSC_INT.pack(a))
+            elif t == "f":
+                parts.append(OSC_FLOAT.pack(a))
+            elif t == "b":
+                parts.append(_osc_blob(a))
+            else:
+                parts.append(_osc_string(a))
+        return "".join(parts)
+    
+    def encode_bundle(self, messages):
+        """ Returns a binary OSC bundle containing the already encoded messages. """
+        return OSC_BUNDLE_HEADER + "".join([OSC_INT.pack(len(m)) + m for m in messages])
+    
+    def decode(self, data, callback, source=None, start=0, end=None, args=None, accept=None):
+        """
+            Decode the OSC message or bundle in data[start:end] (a string or a bytearray receive buffer)
+            and run callback(address, typetags, args, source) for each message in it.
+            args is a list which is emptied and refilled for every message, so callbacks must copy anything they keep.
+            If accept is given, messages are skipped without decoding their arguments unless accept(address) is True.
+        """
+        if end is None:
+            end = len(data)
+        if args is None:
+            args = []
+        term = data.find("\0", start, end)
+        if term < 0:
+            raise SyncjamsException("Malformed OSC address.")
+        address = str(data[start:term])
+        offset = start + _osc_padded(term - start)
+        if address == "#bundle":
+            # skip the time tag - we always handle bundle contents immediately
+            offset += 8
+            while offset + 4 <= end:
+                length = OSC_INT.unpack_from(data, offset)[0]
+                offset += 4
+                self.decode(data, callback, source, offset, min(offset + length, end), args, accept)
+                offset += length
+            return
+        if accept is not None and not accept(address):
+            return
+        term = data.find("\0", offset, end)
+        if term < 0 or data[offset] not in (",", 44):
+            raise SyncjamsException("Malformed OSC type tags.")
+        tags = str(data[offset + 1:term])
+        offset += _osc_padded(term - offset)
+        decoder = self.decoders.get(tags)
+        if decoder is None:
+            decoder = self._compile_decoder(tags)
+        del args[:]
+        for t, numeric in decoder:
+            if t == "?":
+                # leave the types we don't know to pyOSC
+                args.extend(OSC.decodeOSC(str(data[start:end]))[2:])
+                break
+            elif numeric:
+                # a run of ints and floats all unpacked in one go
+                args.extend(numeric.unpack_from(data, offset))
+                offset += numeric.size
+            elif t == "s":
+                term = data.find("\0", offset, end)
+                if term < 0:
+                    raise SyncjamsException("Malformed OSC string.")
+                args.append(str(data[offset:term]))
+                offset += _osc_padded(term - offset)
+            elif t == "b":
+                length = OSC_INT.unpack_from(data, offset)[0]
+                args.append(str(data[offset + 4:offset + 4 + length]))
+                offset += 4 + (length + 3) // 4 * 4
+            else:
+                args.append(OSC_CONSTANT_TAGS[t])
+        callback(address, tags, args, source)
+    
+    def _compile(self, address, tags):
+        if len(self.encoders) >= self.cache_size:
+            self.encoders.clear()
+        # everything up to the first argument after the version never changes for this address and set of types
+        prefix = _osc_string(self.namespace + address) + _osc_string(",s" + tags) + _osc_string(self.version)
+        numeric = not ("s" in tags or "b" in tags) and struct.Struct(">" + tags) or None
+        encoder = self.encoders[(address, tags)] = (prefix, numeric)
+        return encoder
+    
+    def _compile_decoder(self, tags):
+        if len(self.decoders) >= self.cache_size:
+            self.decoders.clear()
+        decoder = []
+        run = ""
+        for t in tags + " ":
+            if t in OSC_NUMERIC_TAGS:
+                run += OSC_NUMERIC_TAGS[t]
+                continue
+            if run:
+                decoder.append(("n", struct.Struct(">" + run)))
+                run = ""
+            if t in "sb" or t in OSC_CONSTANT_TAGS:
+                decoder.append((t, None))
+            elif t != " ":
+                decoder = [("?", None)]
+                break
+        self.decoders[tags] = decoder
+        return decoder
+
 # class that can listen out on a particular ip - reused to listen on different broadcast subnets
 class SyncjamsListener(OSC.OSCServer):
     client = None
     socket_timeout = 0
-    def __init__(self, address, port, callback, *args, **kwargs):
+    def __init__(self, address, port, callback, receive_buffer_size=None, interface=None, *args, **kwargs):
         # check whether we have been asked to listen on a multicast address
-        self.multicast = address.startswith("239.255") or address.startswith("224.")
+        self.multicast = address.split(".")[0].isdigit() and 224 <= int(address.split(".")[0]) <= 239
         self.address = address
+        # network interface (by its IP address) to join the multicast group on
+        self.interface = interface or ANY
         # set up the OSC server to listen
         OSC.OSCServer.__init__(self, (self.multicast and ANY or address, port), *args, **kwargs)
         # whatever messages come in, run the main callback
-        self.addMsgHandler("default", callback)
+        self.callback = callback
+        # function deciding from its address whether each message is worth decoding, if any
+        self.accept = None
+        if callback:
+            self.addMsgHandler("default", callback)
+        # make the kernel queue more packets for us between polls
+        if receive_buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        # datagrams are read into this same buffer every time and decoded into the same argument list
+        self.receive_buffer = bytearray(MAX_DATAGRAM)
+        self.receive_args = []
+        self.codec = SyncjamsCodec()
+    
+    def handle_pending(self, max_packets=POLL_MAX_PACKETS, deadline=None):
+        """
+            Process waiting datagrams without blocking until there are none left, max_packets have been handled or time.time() passes deadline.
+            Returns (packets_processed, more_pending).
+        """
+        processed = 0
+        while processed < max_packets and (deadline is None or time.time() < deadline):
+            try:
+                size, source = self.socket.recvfrom_into(self.receive_buffer)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return processed, False
+                raise
+            processed += 1
+            try:
+                self.codec.decode(self.receive_buffer, self.callback, source, 0, size, self.receive_args, self.accept)
+            except Exception, e:
+                # one bad packet should not stop us processing the rest
+                logging.warning("Error handling packet from %s: %r", OSC.getUrlStr(source), e)
+        # budget ran out - let the caller know whether there is more waiting
+        return processed, bool(select.select([self.socket], [], [], 0)[0])
     
     def server_bind(self):
         # allow multiple receivers on the same IP
@@ -456,9 +2218,350 @@ class SyncjamsListener(OSC.OSCServer):
         # finally set the multicast options if this is a multicast socket
         self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
         if self.multicast:
-            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self.address) + socket.inet_aton(ANY))
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(self.address) + socket.inet_aton(self.interface))
         return result
 
+class UDPTransport:
+    """
+        Carries a node's packets over real UDP sockets - one sender socket for every destination
+        (broadcast addresses or a multicast group) and a listener on the SyncJams port.
+    """
+    def __init__(self, port=PORT, destinations=None, multicast=False, multicast_interface=None, multicast_ttl=MULTICAST_TTL, receive_buffer_size=None):
+        self.port = port
+        # multicast group to join and send to instead of broadcasting (True for the default SyncJams group)
+        self.multicast_group = multicast is True and ADDRESSES["multicast"] or multicast or None
+        # every (host, port) we send each packet to - names from ADDRESSES or IP addresses
+        destinations = destinations or (self.multicast_group and [self.multicast_group]) or DESTINATIONS
+        self.destinations = [(ADDRESSES.get(d, d), self.port) for d in destinations]
+        # set up a single osc sender to send out broadcast/multicast messages
+        self.sender = self._make_sender(multicast_interface, multicast_ttl)
+        # set up servers to listen on each broadcast address we want to listen on
+        self.listeners = [SyncjamsListener(self.multicast_group or ANY, self.port, callback=None, receive_buffer_size=receive_buffer_size, interface=multicast_interface)]
+    
+    def start(self, callback, accept=None):
+        """
+            Run callback(address, typetags, args, source) for every message received from now on.
+            If accept is given, messages whose address it returns False for are skipped before their arguments are decoded.
+        """
+        for l in self.listeners:
+            l.callback = callback
+            l.accept = accept
+            l.addMsgHandler("default", callback)
+    
+    def send(self, data):
+        """ Send one datagram to every destination. """
+        logging.debug("raw sent packet %r", data)
+        # send one message out to all broadcast/multicast networks possible, ignoring errors
+        sent = False
+        for destination in self.destinations:
+            try:
+                self.sender.sendto(data, destination)
+                sent = True
+            except socket.error, e:
+                # silently drop socket errors because we'll just keep trying
+                logging.debug("Dropped message send to %s: %s", destination[0], e)
+        # no network at all - at least reach other nodes on this machine
+        if not sent:
+            try:
+                self.sender.sendto(data, (ADDRESSES["localhost"], self.port))
+            except socket.error, e:
+                logging.warning("Dropped message send: %s", e)
+    
+    def receive(self, max_packets=POLL_MAX_PACKETS, deadline=None):
+        """ Handle waiting datagrams within the budget. Returns (packets_processed, more_pending). """
+        processed = 0
+        pending = False
+        for l in self.listeners:
+            handled, waiting = l.handle_pending(max_packets - processed, deadline)
+            processed += handled
+            pending = pending or waiting
+        return processed, pending
+    
+    def filenos(self):
+        """ File descriptors to select() on to find out when there are packets to receive. """
+        return [l.fileno() for l in self.listeners]
+    
+    def close(self):
+        [l.close() for l in self.listeners]
+        self.sender.close()
+    
+    def _make_sender(self, multicast_interface=None, multicast_ttl=MULTICAST_TTL):
+        # UDP socket that sends with broadcast flags on from any assigned port
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sender.bind((ANY, 0))
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+        # make sure nodes on this machine hear our multicast packets too
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        # send multicast out of a particular network interface (by its IP address)
+        if multicast_interface:
+            sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(multicast_interface))
+        return sender
+
+class HostedTransport:
+    """
+        Transport for a node running as one session of a SyncjamsHost. Packets go out through the host's shared sender,
+        and the host hands this session the incoming messages addressed to its namespace, so there is nothing to receive here.
+    """
+    def __init__(self, host):
+        self.host = host
+        self.callback = None
+        self.accept = None
+    
+    def start(self, callback, accept=None):
+        self.callback = callback
+        self.accept = accept
+    
+    def send(self, data):
+        self.host.transport.send(data)
+    
+    def receive(self, max_packets=POLL_MAX_PACKETS, deadline=None):
+        return 0, False
+    
+    def filenos(self):
+        return []
+    
+    def close(self):
+        # the sockets belong to the host and the other sessions are still using them
+        self.callback = None
+        self.accept = None
+
+class SyncjamsLoop:
+    """
+        Runs any number of SyncjamsNodes in a single thread.
+        Sleeps in select() until one of the nodes' sockets has a packet or the next tick/throttled state is due, so idle nodes use no CPU.
+    """
+    def __init__(self, nodes=[]):
+        self.nodes = []
+        self.running = False
+        # loopback socket that other threads can poke to wake us up from select()
+        self.waker = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.waker.bind(("127.0.0.1", 0))
+        self.waker.setblocking(0)
+        for n in nodes:
+            self.add(n)
+    
+    def add(self, node):
+        """ Start running a node in this loop. """
+        node.loop = self
+        node.running = True
+        self.nodes.append(node)
+        self.wake()
+    
+    def remove(self, node):
+        """ Stop running a node in this loop. The loop exits once it has no nodes left. """
+        if node in self.nodes:
+            self.nodes.remove(node)
+        node.loop = None
+        self.wake()
+    
+    def wake(self, node=None):
+        """ Interrupt the select() so that timeouts are recalculated (node's, if given) - safe to call from any thread. """
+        try:
+            self.waker.sendto("!", self.waker.getsockname())
+        except socket.error:
+            pass
+    
+    def run(self):
+        """ Process network packets and timers for all nodes until stop() is called or all nodes are closed. """
+        self.running = True
+        while self.running and self.nodes:
+            nodes = self.nodes[:]
+            timeout = min([n.next_timeout() for n in nodes])
+            # listener socket file descriptor -> node
+            listeners = dict([(fd, n) for n in nodes for fd in n.transport.filenos()])
+            try:
+                readable = select.select(listeners.keys() + [self.waker.fileno()], [], [], timeout)[0]
+            except (select.error, socket.error, ValueError), e:
+                # a node was probably closed from another thread while we were waiting on it
+                logging.debug("select interrupted: %s", e)
+                continue
+            self._drain_waker()
+            ready = set([listeners[l] for l in readable if l in listeners])
+            for n in nodes:
+                if n.loop is self and (n in ready or not n.next_timeout()):
+                    n.poll()
+        self.running = False
+    
+    def stop(self):
+        """ Make run() return after its current iteration - safe to call from any thread. """
+        self.running = False
+        self.wake()
+    
+    def close(self):
+        self.waker.close()
+    
+    def _drain_waker(self):
+        try:
+            while self.waker.recv(64):
+                pass
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+class SyncjamsHost(SyncjamsLoop):
+    """
+        Runs many SyncjamsNode sessions, each in its own namespace, over one shared sender and listener.
+        Every datagram is decoded once and handed to the session its namespace belongs to with a dict lookup,
+        and a session is only polled when it receives a packet or its next timer is due - so hundreds of quiet
+        sessions cost next to nothing and the work done grows with the traffic rather than sessions x traffic.
+    """
+    def __init__(self, port=PORT, destinations=None, multicast=False, multicast_interface=None, multicast_ttl=MULTICAST_TTL, receive_buffer_size=None, poll_max_packets=POLL_MAX_PACKETS, poll_max_time=POLL_MAX_TIME, transport=None, clock=None, metrics=True):
+        SyncjamsLoop.__init__(self)
+        # where all the times we and our sessions use come from
+        self.clock = clock or monotonic
+        # budget of packets/seconds each poll() may spend receiving for all sessions together
+        self.poll_max_packets = poll_max_packets
+        self.poll_max_time = poll_max_time
+        # namespace -> the node running in it
+        self.sessions = {}
+        # most address segments any of our namespaces has, so we know how far to look for one
+        self.namespace_depth = 0
+        # the session the message being decoded belongs to (found while accepting its address)
+        self.current = None
+        # sessions that have received packets, or been woken, since they were last polled
+        self.touched = set()
+        self.woken = set()
+        # heap of when each session next has timed work to do (due_time, sequence, node)
+        # entries left behind when a session is rescheduled are skipped as they come out
+        self.deadlines = []
+        self.deadline_sequence = count()
+        # the due_time of each session's current entry in the deadlines heap
+        self.due = {}
+        # counters for packets that reach us and are not for any session
+        self.metrics = SyncjamsMetrics(metrics)
+        # the one pair of sockets every session sends and receives through
+        self.transport = transport or UDPTransport(port, destinations, multicast, multicast_interface, multicast_ttl, receive_buffer_size)
+        self.transport.start(self._handle_packet, self._accept_address)
+    
+    def add_node(self, node_class=SyncjamsNode, namespace=NAMESPACE, **kwargs):
+        """ Create a node of node_class running as a session in namespace on this host. """
+        if namespace in self.sessions:
+            raise SyncjamsException("There is already a session in namespace %s." % namespace)
+        node = node_class(namespace=namespace, transport=HostedTransport(self), clock=self.clock, **kwargs)
+        self.add(node)
+        return node
+    
+    def add(self, node):
+        """ Start running a node created with a HostedTransport of this host as a session. """
+        if node.namespace in self.sessions:
+            raise SyncjamsException("There is already a session in namespace %s." % node.namespace)
+        node.loop = self
+        node.running = True
+        self.sessions[node.namespace] = node
+        self.namespace_depth = max(self.namespace_depth, node.namespace.count("/"))
+        self.wake(node)
+    
+    def remove(self, node):
+        """ Stop running a session. Other sessions carry on, and the host runs until stop() is called. """
+        if self.sessions.get(node.namespace) is node:
+            del self.sessions[node.namespace]
+        self.due.pop(node, None)
+        self.touched.discard(node)
+        self.woken.discard(node)
+        node.loop = None
+    
+    def wake(self, node=None):
+        """ Make sure node (if given) gets polled and its timeouts recalculated soon - safe to call from any thread. """
+        if node is not None:
+            self.woken.add(node)
+        SyncjamsLoop.wake(self)
+    
+    def get_metrics(self):
+        """ Returns a snapshot of the host's own counters (each session's are in its get_metrics()). """
+        return self.metrics.snapshot()
+    
+    def poll(self, max_packets=None, max_time=None):
+        """
+            Receive waiting packets for all sessions, then poll every session that got packets or has timed work due.
+            Returns (packets_processed, more_pending) like SyncjamsNode.poll().
+        """
+        started = time.time()
+        processed, pending = self.transport.receive(max_packets or self.poll_max_packets, started + (max_time or self.poll_max_time))
+        now = self.clock()
+        ready, self.touched = self.touched, set()
+        woken, self.woken = self.woken, set()
+        ready.update(woken)
+        while self.deadlines and self.deadlines[0][0] <= now:
+            due, sequence, node = heappop(self.deadlines)
+            if self.due.get(node) == due:
+                del self.due[node]
+                ready.add(node)
+        for node in ready:
+            if node.loop is self:
+                node.poll()
+                self._schedule(node, now)
+        return processed, pending
+    
+    def next_timeout(self, now=None):
+        """ Returns how many seconds until any session next has timed work to do - poll() can wait this long if no packets arrive. """
+        if self.touched or self.woken:
+            return 0
+        # throw away the entries of sessions that have been rescheduled or removed
+        while self.deadlines and self.due.get(self.deadlines[0][2]) != self.deadlines[0][0]:
+            heappop(self.deadlines)
+        if not self.deadlines:
+            return HOST_IDLE_TIMEOUT
+        return max(0, self.deadlines[0][0] - (now or self.clock()))
+    
+    def run(self):
+        """ Process network packets and timers for all sessions until stop() is called. """
+        self.running = True
+        while self.running:
+            try:
+                select.select(self.transport.filenos() + [self.waker.fileno()], [], [], self.next_timeout())
+            except (select.error, socket.error, ValueError), e:
+                logging.debug("select interrupted: %s", e)
+                continue
+            self._drain_waker()
+            self.poll()
+        self.running = False
+    
+    def close(self):
+        """ Close every session (so they say goodbye to their groups) and then the shared sockets. """
+        for node in self.sessions.values():
+            node.close()
+        self.transport.close()
+        SyncjamsLoop.close(self)
+    
+    def _schedule(self, node, now):
+        due = now + node.next_timeout(now)
+        if self.due.get(node) != due:
+            self.due[node] = due
+            heappush(self.deadlines, (due, self.deadline_sequence.next(), node))
+    
+    def _find_session(self, addr):
+        # try each leading run of address segments as a namespace, longest first (so a nested namespace gets its own messages)
+        ends = []
+        end = 0
+        for depth in xrange(self.namespace_depth):
+            end = addr.find("/", end + 1)
+            if end < 0:
+                break
+            ends.append(end)
+        for end in reversed(ends):
+            node = self.sessions.get(addr[:end])
+            if node is not None:
+                return node
+        return None
+    
+    def _accept_address(self, addr):
+        # work out which session each message is for before its arguments are decoded
+        self.current = node = self._find_session(addr)
+        if node is None:
+            self.metrics.count("drops.No session")
+            return False
+        accept = node.transport.accept
+        return accept is None or accept(addr)
+    
+    def _handle_packet(self, addr, tags, packet, source):
+        node = self.current
+        self.current = None
+        if node is not None and node.loop is self:
+            self.touched.add(node)
+            node.transport.callback(addr, tags, packet, source)
+
 # Test code for running an interactive version that prints results
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# PEP8 all up in here:
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4 smartindent
+
+"""
+    In-process simulation of a network of SyncJams nodes running in virtual time.
+    Nodes are ordinary SyncjamsNodes given a SimulatedTransport and the simulation's VirtualClock.
+"""
+
+import time
+from random import Random
+from heapq import heappush, heappop
+from itertools import count
+from collections import deque
+
+from syncjams import SyncjamsNode, SyncjamsHost, SyncjamsCodec, POLL_MAX_PACKETS
+
+# smallest step of virtual time - makes sure timers that are due "now" actually fire
+TIME_EPSILON = 1e-6
+
+class VirtualClock:
+    """ A clock that only moves when it is told to. Pass it as a SyncjamsNode's clock. """
+    def __init__(self, start=1000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class SimulatedNetwork:
+    """
+        A broadcast network where every packet sent reaches every other transport after a latency +/- jitter,
+        unless it is lost or the two transports are on different sides of a partition.
+        A reordered packet is held back by up to a further two latencies.
+    """
+    def __init__(self, clock=None, latency=0.002, jitter=0.001, loss=0.0, reorder=0.0, seed=None):
+        self.clock = clock or VirtualClock()
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.random = Random(seed)
+        self.transports = []
+        # packets on their way (deliver_time, sequence, transport, data, source)
+        self.in_flight = []
+        self.sequence = count()
+        # transport -> partition group number (None when the network is whole)
+        self.partitions = None
+        # counters
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.packets_delivered = 0
+        self.packets_lost = 0
+
+    def transport(self):
+        """ Returns a new transport attached to this network. """
+        t = SimulatedTransport(self, ("10.0.%d.%d" % divmod(len(self.transports) + 1, 256), 23232))
+        self.transports.append(t)
+        return t
+
+    def remove(self, transport):
+        if transport in self.transports:
+            self.transports.remove(transport)
+
+    def partition(self, *groups):
+        """ Split the network so that only transports in the same group can hear each other. """
+        self.partitions = {}
+        for g, group in enumerate(groups):
+            for t in group:
+                self.partitions[t] = g
+
+    def heal(self):
+        """ Join all partitions back together. """
+        self.partitions = None
+
+    def send(self, source, data):
+        self.packets_sent += 1
+        self.bytes_sent += len(data)
+        now = self.clock()
+        for t in self.transports:
+            # broadcast packets come back to the sender too
+            if self.partitions and self.partitions.get(t) != self.partitions.get(source):
+                continue
+            if self.loss and self.random.random() < self.loss:
+                self.packets_lost += 1
+                continue
+            delay = max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            if self.reorder and self.random.random() < self.reorder:
+                delay += self.random.uniform(0, 2 * self.latency)
+            heappush(self.in_flight, (now + delay, self.sequence.next(), t, data, source.address))
+
+    def deliver(self, now=None):
+        """ Move every packet that has arrived by now into its transport's inbox. """
+        now = now or self.clock()
+        while self.in_flight and self.in_flight[0][0] <= now:
+            due, sequence, t, data, source = heappop(self.in_flight)
+            t.inbox.append((data, source))
+            self.packets_delivered += 1
+
+    def next_delivery(self):
+        """ Virtual time the next packet arrives, or None. """
+        return self.in_flight and self.in_flight[0][0] or None
+
+class SimulatedTransport:
+    """ SyncjamsNode transport that sends into and receives from a SimulatedNetwork. """
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.inbox = deque()
+        self.callback = None
+        self.accept = None
+        self.codec = SyncjamsCodec()
+        self.receive_args = []
+
+    def start(self, callback, accept=None):
+        self.callback = callback
+        self.accept = accept
+
+    def send(self, data):
+        self.network.send(self, data)
+
+    def receive(self, max_packets=POLL_MAX_PACKETS, deadline=None):
+        processed = 0
+        while self.inbox and processed < max_packets:
+            data, source = self.inbox.popleft()
+            processed += 1
+            self.codec.decode(data, self.callback, source, 0, len(data), self.receive_args, self.accept)
+        return processed, bool(self.inbox)
+
+    def filenos(self):
+        return []
+
+    def close(self):
+        self.network.remove(self)
+
+class Simulation:
+    """
+        Runs SyncjamsNodes on a SimulatedNetwork, jumping the virtual clock straight from one
+        packet arrival or node timer to the next so that idle time costs nothing to simulate.
+    """
+    def __init__(self, latency=0.002, jitter=0.001, loss=0.0, reorder=0.0, seed=None):
+        self.clock = VirtualClock()
+        self.network = SimulatedNetwork(self.clock, latency, jitter, loss, reorder, seed)
+        self.nodes = []
+        # node -> real seconds spent inside its poll()
+        self.poll_time = {}
+
+    def add_node(self, node_class=SyncjamsNode, **kwargs):
+        """ Create a node of node_class attached to the simulated network and clock. """
+        node = node_class(transport=self.network.transport(), clock=self.clock, **kwargs)
+        self.nodes.append(node)
+        self.poll_time[node] = 0.0
+        return node
+
+    def add_host(self, **kwargs):
+        """ Create a SyncjamsHost attached to the simulated network and clock - add sessions with its add_node(). """
+        host = SyncjamsHost(transport=self.network.transport(), clock=self.clock, **kwargs)
+        # the host is polled like a node, and polls whichever of its sessions are due
+        self.nodes.append(host)
+        self.poll_time[host] = 0.0
+        return host
+
+    def remove_node(self, node):
+        node.close()
+        self.nodes.remove(node)
+
+    def run(self, duration, until=None):
+        """ Advance virtual time by duration seconds, or until until() returns True. Returns the virtual time at which it stopped. """
+        end = self.clock() + duration
+        while self.clock() < end:
+            if until and until():
+                break
+            self.step(end)
+        return self.clock()
+
+    def step(self, end=None):
+        """ Jump to the next packet arrival or node timer (but not past end) and process it. """
+        now = self.clock()
+        due = [now + n.next_timeout(now) for n in self.nodes]
+        arrival = self.network.next_delivery()
+        if arrival is not None:
+            due.append(arrival)
+        then = max(min(due or [end]), now) + TIME_EPSILON
+        if end is not None:
+            then = min(then, end)
+        self.clock.now = then
+        self.network.deliver(then)
+        for n in self.nodes:
+            if n.transport.inbox or not n.next_timeout(then):
+                started = time.time()
+                while n.poll()[1]:
+                    pass
+                self.poll_time[n] += time.time() - started
@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+
+# PEP8 all up in here:
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4 smartindent
+
+"""
+    Tests for the SyncJams Python implementation.
+    Nodes run on a syncjams_sim.Simulation so no real network is needed.
+    Run with: python -m unittest test_syncjams
+"""
+
+import os
+import struct
+import shutil
+import tempfile
+import threading
+import unittest
+from random import Random
+
+import OSC
+
+import syncjams
+from syncjams import SortedChecksum, EventQueue, SyncjamsCodec, NAMESPACE, PROTOCOL_VERSION
+from syncjams_sim import Simulation
+
+class ChecksumTest(unittest.TestCase):
+    def setUp(self):
+        self.node = Simulation(seed=1).add_node()
+
+    def tearDown(self):
+        self.node.close()
+
+    def test_array_checksum_vectors(self):
+        # the test values documented in SyncjamsNode._array_checksum
+        self.assertEqual(self.node._array_checksum([12, 432, 3, 0, 2343]), 28632)
+        self.assertEqual(self.node._array_checksum([0.223, 4234, 0.242435, .76653, 3, 23.35, 656, 43]), 37187)
+        self.assertEqual(self.node._array_checksum([122112, 4321, 123, 11, 14, 4, 43, 8388606, 3, 432, 545]), 36600)
+
+    def test_sorted_checksum_matches_array_checksum(self):
+        random = Random(1)
+        column = SortedChecksum()
+        values = []
+        self.assertEqual(column.checksum(), self.node._array_checksum([]))
+        for n in range(2000):
+            if values and random.random() < 0.5:
+                # replace a value, as when a state is overwritten
+                old = values.pop(random.randrange(len(values)))
+                new = random.randint(0, pow(2, 23))
+                column.replace(old, new)
+                values.append(new)
+            else:
+                new = random.randint(0, pow(2, 23))
+                column.add(new)
+                values.append(new)
+            # fold only now and then so several changes are re-folded at once
+            if random.random() < 0.2:
+                self.assertEqual(column.checksum(), self.node._array_checksum(sorted(values)))
+        self.assertEqual(column.checksum(), self.node._array_checksum(sorted(values)))
+
+# (address, arguments after the protocol version) - floats that survive 32 bits exactly so they compare equal
+CODEC_MESSAGES = [
+    ("/tick", [4534126, 1024, 28632, 37187, 36600]),
+    ("/state/fader/volume", [4534126, 2051, 1024, 0.5, 96]),
+    ("/state/key/0", [4534126, 2052, 1024, -0.25, "chord", "maj7", 61]),
+    ("/leave", [4534126, 7]),
+    ("/some/message", ["abc", "", "abcd", 0.0, -1]),
+]
+
+def pyosc_encode(address, args):
+    message = OSC.OSCMessage()
+    message.setAddress(NAMESPACE + address)
+    message.append(PROTOCOL_VERSION)
+    for a in args:
+        message.append(a)
+    return message.getBinary()
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        self.codec = SyncjamsCodec()
+        self.decoded = []
+
+    def record(self, address, tags, args, source):
+        self.decoded.append((address, tags, list(args)))
+
+    def test_encode_matches_pyosc(self):
+        for address, args in CODEC_MESSAGES:
+            self.assertEqual(self.codec.encode(address, args), pyosc_encode(address, args))
+
+    def test_blob(self):
+        # (pyOSC writes the padded length in a blob's size, so only the codec's own round trip is checked)
+        data = self.codec.encode("/snapshot", [1, bytearray("\x00\x01zlib")])
+        self.assertEqual(data[-12:], struct.pack(">i", 6) + "\x00\x01zlib\0\0")
+        self.codec.decode(data, self.record)
+        self.assertEqual(self.decoded, [(NAMESPACE + "/snapshot", "sib", [PROTOCOL_VERSION, 1, "\x00\x01zlib"])])
+
+    def test_round_trip(self):
+        for address, args in CODEC_MESSAGES:
+            for data in (self.codec.encode(address, args), pyosc_encode(address, args)):
+                del self.decoded[:]
+                self.codec.decode(data, self.record)
+                self.assertEqual([(a, decoded) for a, tags, decoded in self.decoded], [(NAMESPACE + address, [PROTOCOL_VERSION] + args)])
+                self.assertEqual(OSC.decodeOSC(data)[2:], [PROTOCOL_VERSION] + args)
+
+    def test_bundle(self):
+        messages = [self.codec.encode(address, args) for address, args in CODEC_MESSAGES]
+        # decoded from a reused receive buffer, as the listener does
+        data = self.codec.encode_bundle(messages)
+        buffer = bytearray(len(data) + 100)
+        buffer[:len(data)] = data
+        self.codec.decode(buffer, self.record, None, 0, len(data), [])
+        self.assertEqual([(a, decoded) for a, tags, decoded in self.decoded], [(NAMESPACE + address, [PROTOCOL_VERSION] + args) for address, args in CODEC_MESSAGES])
+
+    def test_other_types(self):
+        # doubles, 64 bit ints and the argument-less true/false/nil from other OSC software
+        data = "/syncjams/x\0,sdhTFNi\0\0\0\0" + "v2\0\0" + struct.pack(">dqi", 0.1, pow(2, 40), 5)
+        self.codec.decode(data, self.record)
+        self.assertEqual(self.decoded, [("/syncjams/x", "sdhTFNi", ["v2", 0.1, pow(2, 40), True, False, None, 5])])
+
+    def test_unknown_types_go_to_pyosc(self):
+        data = "/syncjams/x\0,sc\0" + "v2\0\0" + struct.pack(">i", 65)
+        decode = OSC.decodeOSC
+        OSC.decodeOSC = lambda data: ["/syncjams/x", ",sc", "v2", "A"]
+        try:
+            self.codec.decode(data, self.record)
+        finally:
+            OSC.decodeOSC = decode
+        self.assertEqual(self.decoded, [("/syncjams/x", "sc", ["v2", "A"])])
+
+class StateIdsNode(syncjams.SyncjamsNode):
+    """ Reconciles state like the Pd implementation - no digests, just the whole list of state ids. """
+    def _osc_message_handler(self, addr, tags, packet, source):
+        if not addr.startswith((self.namespace + "/state-digest", self.namespace + "/state-bucket-ids")):
+            syncjams.SyncjamsNode._osc_message_handler(self, addr, tags, packet, source)
+
+    def _broadcast_state_digest(self, level=0, prefix=0):
+        self._broadcast_state_ids()
+
+class StateDigestTest(unittest.TestCase):
+    def test_nodes_without_digests(self):
+        # states only a node that doesn't understand digests holds still reach everybody else after a partition heals
+        sim = Simulation(seed=1)
+        nodes = [sim.add_node() for n in range(2)]
+        old = sim.add_node(StateIdsNode)
+        sim.network.partition([n.transport for n in nodes], [old.transport])
+        sim.run(1.0)
+        old.set_state("/old", 1)
+        nodes[0].set_state("/new", 2)
+        sim.run(1.0)
+        sim.network.heal()
+        sim.run(3.0)
+        for n in nodes + [old]:
+            self.assertEqual((n.get_state("/old"), n.get_state("/new")), (1, 2))
+        [n.close() for n in nodes + [old]]
+
+class SubscriptionTest(unittest.TestCase):
+    def test_ticks_agree_with_the_group(self):
+        # a node holding part of the state repeats the group's checksums, so nodes that don't know it only subscribes agree with it
+        sim = Simulation(seed=1)
+        full = sim.add_node()
+        part = sim.add_node()
+        part.subscribe("/fader/*")
+        full.set_state("/fader/1", 1)
+        full.set_state("/other", 2)
+        sim.run(2.0)
+        self.assertEqual(part.get_state("/fader/1"), 1)
+        self.assertEqual(part.get_state("/other"), None)
+        ticks = []
+        send = part._send_one_to_all
+        def record(address, message, bundle=False):
+            if address == "/tick":
+                ticks.append(message[2:])
+            send(address, message, bundle)
+        part._send_one_to_all = record
+        sim.run(2.0)
+        self.assertTrue(ticks)
+        self.assertEqual(ticks, [full._get_state_checksums()] * len(ticks))
+        self.assertEqual(full.get_metrics()["counters"].get("checksum_mismatches"), None)
+        [n.close() for n in (full, part)]
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        # no jitter, so which node hears which change first is decided by when they were sent
+        self.sim = Simulation(jitter=0, seed=1)
+        self.nodes = [self.sim.add_node(delta_states=True) for n in range(3)]
+        self.sim.run(2.0)
+        self.base = range(64)
+        self.nodes[0].set_state("/list", self.base)
+        self.sim.run(1.0)
+
+    def tearDown(self):
+        [n.close() for n in self.nodes]
+
+    def changed(self, index, value):
+        return self.base[:index] + [value] + self.base[index + 1:]
+
+    def counter(self, node, name):
+        return node.get_metrics()["counters"].get(name, 0)
+
+    def test_patch(self):
+        a, b, c = self.nodes
+        a.set_state("/list", self.changed(20, 200))
+        self.sim.run(1.0)
+        self.assertEqual(self.counter(a, "state_deltas_sent"), 1)
+        for n in self.nodes:
+            self.assertEqual(n.get_state("/list"), self.changed(20, 200))
+            self.assertEqual(self.counter(n, "state_deltas_applied"), 1)
+            self.assertEqual(self.counter(n, "state_delta_misses"), 0)
+
+    def test_base_mismatch(self):
+        # b's change gets to everybody before a's, so a's delta no longer matches what b and c hold
+        a, b, c = self.nodes
+        b.set_state("/list", self.changed(10, 100))
+        self.sim.run(0.001)
+        a.set_state("/list", self.changed(20, 200))
+        self.sim.run(1.0)
+        for n in (b, c):
+            self.assertEqual(self.counter(n, "state_delta_misses"), 1)
+        self.assertEqual(self.counter(a, "state_requests_answered"), 1)
+        for n in self.nodes:
+            self.assertEqual(n.get_state("/list"), self.changed(20, 200))
+
+    def test_own_delta_loopback(self):
+        # a's own delta comes back after b's change, but a knows what it sent so it doesn't need to ask
+        a, b, c = self.nodes
+        b.set_state("/list", self.changed(10, 100))
+        self.sim.run(0.001)
+        a.set_state("/list", self.changed(20, 200))
+        self.sim.run(0.01)
+        self.assertEqual(a.get_state("/list"), self.changed(20, 200))
+        self.assertEqual(self.counter(a, "state_deltas_applied"), 2)
+        self.assertEqual(self.counter(a, "state_delta_misses"), 0)
+
+class MetricsTest(unittest.TestCase):
+    def test_disabled(self):
+        sim = Simulation(seed=1)
+        quiet = sim.add_node(metrics=False)
+        other = sim.add_node()
+        sim.run(1.0)
+        other.set_state("/fader", 1)
+        other.send("/hit", 2)
+        sim.run(1.0)
+        self.assertEqual(quiet.get_state("/fader"), 1)
+        self.assertEqual(quiet.get_metrics(), {"counters": {}, "histograms": {}})
+        [n.close() for n in (quiet, other)]
+
+    def test_message_addresses_share_a_counter(self):
+        sim = Simulation(seed=1)
+        nodes = [sim.add_node() for n in range(2)]
+        sim.run(1.0)
+        for n in range(50):
+            nodes[0].send("/hit%d/x" % n, n)
+        sim.run(1.0)
+        for node in nodes:
+            counters = node.get_metrics()["counters"]
+            # (jitter reorders a few, and the re-sends asked for are counted too)
+            self.assertTrue(counters["packets_in.message"] >= 50)
+            self.assertEqual([c for c in counters if c.startswith("packets_") and "hit" in c], [])
+        self.assertTrue(nodes[0].get_metrics()["counters"]["packets_out.message"] >= 50)
+        [n.close() for n in nodes]
+
+class TickTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = Simulation(seed=1)
+        self.node = self.sim.add_node()
+
+    def tearDown(self):
+        self.node.close()
+
+    def test_bad_tick_number_dropped(self):
+        self.node._handle_packet(NAMESPACE + "/tick", "sis", [PROTOCOL_VERSION, 1234, "x"], ("10.0.0.9", 23232))
+        self.node._handle_packet(NAMESPACE + "/tick", "si", [PROTOCOL_VERSION, 1234], ("10.0.0.9", 23232))
+        self.assertEqual(self.node.get_metrics()["counters"]["drops.No tick number"], 2)
+        self.assertEqual(self.node.get_node_list(), [])
+
+    def test_reserved_addresses(self):
+        for address in ("/ping", "/nack/x", "/snapshot", "/tick", "/state/x"):
+            self.assertRaises(syncjams.SyncjamsException, self.node.send, address, 1)
+        self.node.send("/pings", 1)
+
+class BundleTest(unittest.TestCase):
+    def test_close_sends_waiting_bundle(self):
+        sim = Simulation(seed=1)
+        a = sim.add_node(bundle_states=True)
+        b = sim.add_node(bundle_states=True)
+        sim.run(1.0)
+        a.set_state("/last", 42)
+        sim.remove_node(a)
+        sim.run(0.1)
+        self.assertEqual(b.get_state("/last"), 42)
+        b.close()
+
+class StateLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_set_state_after_restart(self):
+        path = os.path.join(self.directory, "state.log")
+        sim = Simulation(seed=1)
+        node = sim.add_node(state_log=path)
+        sim.run(10.0)
+        node.set_state("/fader", 1)
+        sim.run(0.1)
+        self.assertTrue(node.states.get("/fader").tick > 20)
+        node.close()
+        # restart alone with only the log to go on
+        sim = Simulation(seed=2)
+        node = sim.add_node(state_log=path)
+        self.assertEqual(node.get_state("/fader"), 1)
+        node.set_state("/fader", 2)
+        sim.run(0.1)
+        self.assertEqual(node.get_state("/fader"), 2)
+        node.close()
+
+    def test_group_restart(self):
+        paths = [os.path.join(self.directory, "state-%d.log" % n) for n in range(2)]
+        sim = Simulation(seed=1)
+        nodes = [sim.add_node(state_log=path) for path in paths]
+        sim.run(10.0)
+        nodes[0].set_state("/fader", 1)
+        sim.run(0.1)
+        [n.close() for n in nodes]
+        sim = Simulation(seed=2)
+        nodes = [sim.add_node(state_log=path) for path in paths]
+        sim.run(1.0)
+        nodes[1].set_state("/fader", 2)
+        sim.run(1.0)
+        self.assertEqual([n.get_state("/fader") for n in nodes], [2, 2])
+        [n.close() for n in nodes]
+
+class MessageRecorder(syncjams.SyncjamsNode):
+    """ Node that remembers the regular messages it receives. """
+    def __init__(self, **kwargs):
+        self.messages = []
+        syncjams.SyncjamsNode.__init__(self, **kwargs)
+
+    def message(self, node_id, address, *args):
+        self.messages.append((address,) + args)
+
+class HostTest(unittest.TestCase):
+    def test_nested_namespaces(self):
+        sim = Simulation(seed=1)
+        host = sim.add_host()
+        room = host.add_node(MessageRecorder, namespace="/room1")
+        sub = host.add_node(MessageRecorder, namespace="/room1/sub")
+        room_peer = sim.add_node(namespace="/room1")
+        sub_peer = sim.add_node(namespace="/room1/sub")
+        sim.run(1.0)
+        room_peer.set_state("/fader", 1)
+        sub_peer.set_state("/fader", 2)
+        sub_peer.send("/hit", 3)
+        sim.run(1.0)
+        self.assertEqual(room.get_state("/fader"), 1)
+        self.assertEqual(sub.get_state("/fader"), 2)
+        self.assertEqual(sub.messages, [("/hit", 3)])
+        self.assertEqual(room.messages, [])
+        self.assertEqual(sorted(room.get_node_list()), sorted([room.get_node_id(), room_peer.get_node_id()]))
+        self.assertEqual(sorted(sub.get_node_list()), sorted([sub.get_node_id(), sub_peer.get_node_id()]))
+        [n.close() for n in (host, room_peer, sub_peer)]
+
+class EventQueueTest(unittest.TestCase):
+    def test_shared_producers(self):
+        # several threads calling set_state() etc. at once mustn't lose each other's calls
+        queue = EventQueue(20000, shared=True)
+        made = []
+        def produce(n):
+            for i in range(5000):
+                self.assertTrue(queue.put(made.append, ((n, i),)))
+        producers = [threading.Thread(target=produce, args=(n,)) for n in range(4)]
+        [p.start() for p in producers]
+        ran = 0
+        while any([p.is_alive() for p in producers]) or len(queue):
+            ran += queue.run()
+        [p.join() for p in producers]
+        self.assertEqual(ran, 20000)
+        self.assertEqual(sorted(made), [(n, i) for n in range(4) for i in range(5000)])
+
+class TickSpeakerTest(unittest.TestCase):
+    def setUp(self):
+        # no heartbeat ticks, so only the nodes speaking for the group are heard
+        self.heartbeat = syncjams.TICK_HEARTBEAT_INTERVAL
+        syncjams.TICK_HEARTBEAT_INTERVAL = 1000.0
+
+    def tearDown(self):
+        syncjams.TICK_HEARTBEAT_INTERVAL = self.heartbeat
+
+    def test_next_group_takes_over(self):
+        sim = Simulation(seed=1)
+        nodes = [sim.add_node(tick_speakers=3) for n in range(30)]
+        sim.run(3.0)
+        # just after the start of an epoch, so the same nodes stay chosen while we watch
+        sim.run(10.0, until=lambda: nodes[0].last_tick[0] % syncjams.TICK_SPEAKER_EPOCH == 1)
+        tick_length = nodes[0]._tick_length()
+        chosen = [n for n in nodes if n._tick_speaker_place()[1] < 3]
+        self.assertEqual(len(chosen), 3)
+        # the chosen nodes go quiet without saying goodbye
+        for n in chosen:
+            sim.network.remove(n.transport)
+            sim.nodes.remove(n)
+        sim.run(tick_length * 6)
+        recently = sim.clock() - tick_length * 2
+        speaking = [n._tick_speaker_place()[1] for n in sim.nodes if n.tick_sent and n.tick_sent > recently]
+        self.assertEqual(sorted(speaking), [3, 4, 5])
+        [n.close() for n in sim.nodes]
+
+if __name__ == "__main__":
+    unittest.main()